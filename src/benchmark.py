@@ -0,0 +1,195 @@
+"""
+benchmark suite for the deep kernel models.
+
+times (median of repeats) and memory profiles (peak RSS growth of a fresh forked process per case)
+vectorized.ker, rkhs_fn, DeepKernelRegression forward and backward, e2eKRR and e2eSKRR while sweeping
+the number of points, the layer width, the depth and the kernel type.
+
+usage:
+    python benchmark.py --points 10 20 --widths 2 8 --output bench.json
+    python benchmark.py --points 10 20 --widths 2 8 --output new.json --baseline bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import statistics
+import time
+import torch
+import torch.nn as nn
+import gpytorch as gpy
+from compositeKRR import DeepKernelRegression
+from utils import createSyntheticData, e2eKRR, e2eSKRR
+from vectorized import ker, rkhs_fn
+
+def make_kernel(kernel_type):
+    if kernel_type == 'polynomial':
+        return gpy.kernels.PolynomialKernel(2)
+    if kernel_type == 'matern':
+        return gpy.kernels.MaternKernel()
+    if kernel_type == 'rbf':
+        return gpy.kernels.RBFKernel()
+    raise ValueError('unknown kernel type: ' + kernel_type)
+
+def make_model(data_x, width, depth, kernel_type):
+    # depth - 1 hidden layers of `kernel_type` with `width` outputs followed by a scalar matern layer.
+    kernels = [make_kernel(kernel_type) for _ in range(depth - 1)] + [gpy.kernels.MaternKernel()]
+    ranges = [width]*(depth - 1) + [1]
+    return DeepKernelRegression(ranges, data_x, kernels, 'cpu')
+
+def make_case(case):
+    """
+    returns (prepare, run): prepare() builds the untimed state of one repeat, run(state) is timed.
+    """
+    _,_,data_x,data_y,_ = createSyntheticData(case['points'])
+    name = case['name']
+
+    if name in ['ker', 'rkhs_fn']:
+        kernel = make_kernel(case['kernel'])
+        weights = torch.randn([len(data_x), 1, case['width']])
+        if name == 'ker':
+            return (lambda: None), (lambda state: ker(data_x, data_x, kernel, case['width'], 'cpu'))
+        return (lambda: None), (lambda state: rkhs_fn(data_x, data_x, kernel, weights, case['width'], 'cpu'))
+
+    if name in ['forward', 'backward']:
+        model = make_model(data_x, case['width'], case['depth'], case['kernel'])
+        loss_fn = nn.MSELoss()
+        if name == 'forward':
+            return (lambda: None), (lambda state: model(data_x))
+        return (lambda: loss_fn(model(data_x), data_y)), (lambda loss: loss.backward())
+
+    if name == 'e2eKRR':
+        return (lambda: None), (lambda state: e2eKRR(data_x, data_y, [case['width'], 1], 2, 'cpu', case['epochs']))
+    if name == 'e2eSKRR':
+        return (lambda: None), (lambda state: e2eSKRR(data_x, data_y, 'cpu', case['epochs']))
+    raise ValueError('unknown benchmark: ' + name)
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+def current_rss():
+    """
+    resident set size in bytes, from /proc on Linux. elsewhere the peak so far, so the measured growth
+    is the one of the peak (the cases are not isolated there, see run_isolated).
+    """
+    if not os.path.exists('/proc/self/statm'):
+        return peak_rss()
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def run_case(case, repeats=3):
+    torch.manual_seed(0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        prepare, run = make_case(case)
+        run(prepare()) # warmup
+        rss_before = current_rss()
+        times = []
+        for _ in range(repeats):
+            state = prepare()
+            start = time.perf_counter()
+            run(state)
+            times.append(time.perf_counter() - start)
+    return dict(case=case, time_s=statistics.median(times), min_time_s=min(times), peak_bytes=max(peak_rss() - rss_before, 0))
+
+def _child(case, repeats, threads, conn):
+    torch.set_num_threads(threads)
+    conn.send(run_case(case, repeats))
+    conn.close()
+
+def run_isolated(case, repeats=3, threads=1):
+    """
+    run a case in a forked process so that its peak memory is not shadowed by earlier cases.
+    other systems run it in this process, a case that stays below the peak of an earlier one reports 0 bytes.
+    """
+    if platform.system() != 'Linux':
+        torch.set_num_threads(threads)
+        return run_case(case, repeats)
+    ctx = mp.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(target=_child, args=(case, repeats, threads, child_conn))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    return result
+
+def build_cases(points, widths, depths, kernels, epochs, names):
+    cases = []
+    for n in points:
+        for kernel_type in kernels:
+            for width in widths:
+                for name in ['ker', 'rkhs_fn']:
+                    cases.append(dict(name=name, points=n, width=width, kernel=kernel_type))
+                for depth in depths:
+                    for name in ['forward', 'backward']:
+                        cases.append(dict(name=name, points=n, width=width, depth=depth, kernel=kernel_type))
+        for width in widths:
+            cases.append(dict(name='e2eKRR', points=n, width=width, epochs=epochs))
+        cases.append(dict(name='e2eSKRR', points=n, epochs=epochs))
+    return [case for case in cases if case['name'] in names]
+
+def case_key(case):
+    return json.dumps(case, sort_keys=True)
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    ratio new/baseline of time and peak memory for every case present in both,
+    cases slower (or bigger) by more than `tolerance` are regressions.
+    """
+    base = {case_key(r['case']): r for r in baseline['results']}
+    rows = []
+    for r in results['results']:
+        b = base.get(case_key(r['case']))
+        if b is None:
+            continue
+        time_ratio = r['time_s'] / max(b['time_s'], 1e-12)
+        mem_ratio = r['peak_bytes'] / max(b['peak_bytes'], 1) if b['peak_bytes'] > 0 else 1.0
+        rows.append(dict(case=r['case'], time_ratio=time_ratio, mem_ratio=mem_ratio,
+                         regression=time_ratio > 1 + tolerance or mem_ratio > 1 + tolerance))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description='deep kernel regression benchmarks')
+    parser.add_argument('--points', type=int, nargs='+', default=[5, 10, 20], help='points per grid axis (N = points^2)')
+    parser.add_argument('--widths', type=int, nargs='+', default=[2, 8])
+    parser.add_argument('--depths', type=int, nargs='+', default=[2, 3])
+    parser.add_argument('--kernels', nargs='+', default=['polynomial', 'matern', 'rbf'])
+    parser.add_argument('--benchmarks', nargs='+', default=['ker', 'rkhs_fn', 'forward', 'backward', 'e2eKRR', 'e2eSKRR'])
+    parser.add_argument('--epochs', type=int, default=20, help='training epochs for e2eKRR and e2eSKRR')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=None, help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    cases = build_cases(args.points, args.widths, args.depths, args.kernels, args.epochs, args.benchmarks)
+    results = dict(meta=dict(torch=torch.__version__, gpytorch=gpy.__version__, threads=args.threads,
+                             machine=platform.machine(), date=time.strftime('%Y-%m-%d %H:%M:%S')),
+                   results=[])
+    for case in cases:
+        result = run_isolated(case, args.repeats, args.threads)
+        results['results'].append(result)
+        print(f"{case_key(case)}  {result['time_s']*1e3:>10.2f} ms  {result['peak_bytes']/2**20:>9.1f} MiB")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('results written to ', args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare(results, baseline, args.tolerance)
+        for row in rows:
+            flag = 'REGRESSION' if row['regression'] else ''
+            print(f"{case_key(row['case'])}  time x{row['time_ratio']:.2f}  mem x{row['mem_ratio']:.2f}  {flag}")
+        if any(row['regression'] for row in rows):
+            raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
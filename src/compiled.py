@@ -0,0 +1,122 @@
+"""
+compiled forward mode of DeepKernelRegression.
+
+the layer stack is captured once per input shape and reused across epochs, as a TorchScript trace
+or with torch.compile, falling back to the eager closures if neither works. the trace comes first in
+'auto': at the small N of the experiments the per call overhead dominates and the trace removes it
+without torch.compile's compile time. the input layer is
+constant during training, so its kernel matrix (or feature matrix) is looked up eagerly in the
+KernelCache and enters the captured function as an input next to the layer weights.
+"""
+import contextlib
+import torch
+import gpytorch
+from kernel_cache import kernel_key, tensor_key
+from rff import RandomFourierFeatures
+from vectorized import gram, select_centers
+
+BACKENDS = dict(auto=['trace', 'compile', 'eager'], compile=['compile', 'eager'], trace=['trace', 'eager'], eager=['eager'])
+
+def supported(model, X):
+    # the lazy / recompute kernels, the kronecker grid path, profiling and trainable inputs run eagerly.
+    return (model.tile_size is None and not model.recompute and model.grid_axes is None and model.profiler is None
+            and not model._retain_layer_outputs and not X.requires_grad)
+
+def input_layer_matrix(model, X):
+    kernel, landmarks, precision = model.Kernels[0], model.Landmarks[0], model.precision
+    if isinstance(kernel, RandomFourierFeatures):
+        A0 = kernel.features(X if precision is None else X.to(precision.kernel))
+    else:
+        centers = select_centers(X, landmarks, model.kernel_cache)
+        if precision is not None:
+            X, centers = precision.kernel_inputs(X, centers, model.kernel_cache)
+        A0 = gram(X, centers, kernel, model.kernel_cache)
+    return A0.to(model.Weights[0].dtype)
+
+def layer_stack(kernels, landmarks, precision=None):
+    """
+    the composition as a plain function of the input layer matrix and the weights of every layer.
+    """
+    def composite(A0, *weights):
+        prev_val = A0.matmul(weights[0].squeeze(-2))
+        for kernel, curr_landmarks, W in zip(kernels[1:], landmarks[1:], weights[1:]):
+            val = prev_val if precision is None else prev_val.to(precision.kernel)
+            if isinstance(kernel, RandomFourierFeatures):
+                k = kernel.features(val)
+            else:
+                k = gram(val, val if curr_landmarks is None else val.index_select(-2, curr_landmarks), kernel)
+            prev_val = k.to(W.dtype).matmul(W.squeeze(-2))
+        return prev_val
+    return composite
+
+@contextlib.contextmanager
+def frozen_hyperparameters(kernels):
+    # the trace stores the kernel hyperparameters as constants, which it refuses for tensors requiring grad.
+    # they are not trained by the model (DeepKernelRegression.parameters() are the weights).
+    params = [p for kernel in kernels for p in kernel.parameters() if p.requires_grad]
+    for p in params:
+        p.requires_grad_(False)
+    try:
+        yield
+    finally:
+        for p in params:
+            p.requires_grad_(True)
+
+class CompiledForward:
+    def __init__(self, model, mode='auto', max_entries=4):
+        """
+        captured layer stacks of `model`, one per input shape and layer structure.
+        mode: 'auto' (trace, then torch.compile, then eager), 'compile', 'trace' or 'eager'.
+        """
+        self.model = model
+        self.mode = mode
+        self.max_entries = max_entries
+        self.entries = {}
+
+    def _key(self, X):
+        model = self.model
+        # the weights are inputs (in place optimizer steps are seen), only their shapes are part of the key.
+        # the hyperparameters of the traced kernels are constants of the capture.
+        return (tuple(X.shape), X.dtype, str(X.device), tuple(tuple(w.shape) for w in model.Weights),
+                tuple(id(k) for k in model.Kernels), tuple(kernel_key(k) for k in model.Kernels[1:]),
+                tuple(None if lm is None else tensor_key(lm) for lm in model.Landmarks))
+
+    def _capture(self, fn, example):
+        for backend in BACKENDS[self.mode]:
+            try:
+                if backend == 'compile':
+                    if not hasattr(torch, 'compile'):
+                        continue
+                    captured = torch.compile(fn)
+                    captured(*example) # compilation errors surface at the first call.
+                elif backend == 'trace':
+                    with gpytorch.settings.trace_mode(), frozen_hyperparameters(self.model.Kernels):
+                        traced = torch.jit.trace(fn, example, check_trace=False)
+                    # the profiling executor can not differentiate graphs with the hyperparameter constants,
+                    # the trace still saves the python and gpytorch dispatch of every call.
+                    def captured(*args, traced=traced):
+                        with torch.jit.optimized_execution(False):
+                            return traced(*args)
+                else:
+                    captured = fn
+                print('compiled forward: using ', backend)
+                return backend, captured
+            except Exception as e:
+                print('compiled forward: ', backend, ' failed (', type(e).__name__, '), falling back')
+        return 'eager', fn
+
+    def __call__(self, X):
+        model = self.model
+        A0 = input_layer_matrix(model, X)
+        key = self._key(X)
+        if key not in self.entries:
+            fn = layer_stack(model.Kernels, model.Landmarks, model.precision)
+            self.entries[key] = self._capture(fn, (A0, *model.Weights))
+            while len(self.entries) > self.max_entries:
+                self.entries.pop(next(iter(self.entries)))
+        _, captured = self.entries[key]
+        return captured(A0, *model.Weights)
+
+    def backend(self, X):
+        entry = self.entries.get(self._key(X))
+        return None if entry is None else entry[0]
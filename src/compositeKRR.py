@@ -1,8 +1,13 @@
-from vectorized import compose, fn_init
+from vectorized import TiledKernel, compose, fn_init, gram, realize_composite_fns, realize_composite_fns_at, select_centers, select_landmarks
+from kernel_cache import KernelCache, kernel_key, tensor_key
+from kronecker import KroneckerKernel, grid_axes, kronecker_fn, kronecker_terms
+import compiled
+from precision import cast, resolve
+from solvers import cholesky_solve, conjugate_gradient, low_rank_precond, pivoted_cholesky, solve_spd
+from rff import RandomFourierFeatures
 import torch
 import torch.nn as nn
 import gpytorch as gpy
-import torchviz
 
 class SingleLayerKRR(gpy.models.ExactGP):
     def __init__(self, train_x, train_y, likelihood):
@@ -15,6 +20,106 @@ class SingleLayerKRR(gpy.models.ExactGP):
         covar_x = self.covar_module(X)
         return gpy.distributions.MultivariateNormal(mean_x, covar_x)
 
+class KernelRidgeRegression(nn.Module):
+    def __init__(self, kernel=None, ridge=1e-3, solver='auto', max_cholesky_size=4096, tol=1e-6, max_iter=None, precond_rank=64, tile_size=None, kernel_cache=True, precision=None):
+        """
+        closed form single layer kernel ridge regression, (K(X, X) + ridge I) alpha = Y and f(x) = K(x, X) alpha.
+        the direct counterpart of SingleLayerKRR (same default kernel), no iterative training.
+
+        solver: 'cholesky', 'cg' (conjugate gradient preconditioned by a rank `precond_rank` pivoted cholesky
+                factor of K) or 'auto', cholesky up to `max_cholesky_size` points and cg above.
+        tile_size: cg only, products with K are computed from kernel blocks and K is never formed.
+        kernel_cache: the cholesky factors are kept per ridge value (KernelCache.cholesky), refitting another
+                      target or returning to an earlier ridge costs two triangular solves.
+        precision: a precision.PrecisionPolicy (or its name), K is evaluated in its kernel dtype and the
+                   system is solved in its solve dtype, the conditioning of K + ridge I is checked at every fit.
+                   without a policy the system is still solved in float64 (float32 cg breaks down on a few
+                   thousand points) and the predictions come back in the dtype of the targets.
+        """
+        super(KernelRidgeRegression, self).__init__()
+        self.kernel = gpy.kernels.PolynomialKernel(2) if kernel is None else kernel
+        self.precision = resolve(precision)
+        if self.precision is not None:
+            self.kernel = self.kernel.to(dtype=self.precision.kernel)
+        self.ridge = ridge
+        self.solver = solver
+        self.max_cholesky_size = max_cholesky_size
+        self.tol = tol
+        self.max_iter = max_iter
+        self.precond_rank = precond_rank
+        self.tile_size = tile_size
+        self.kernel_cache = KernelCache() if kernel_cache is True else (kernel_cache or None)
+        self.X = None
+        self.alpha = None
+        self._out_dtype = None
+        self._pivots = None
+
+    def _cholesky_fit(self, X, Y, ridge):
+        if self.kernel_cache is not None:
+            return torch.cholesky_solve(Y, self.kernel_cache.cholesky(X, self.kernel, gram, ridge, Y.dtype))
+        K = gram(X, X, self.kernel).to(Y.dtype)
+        return cholesky_solve(K + ridge*torch.eye(K.shape[-1], dtype=K.dtype, device=K.device), Y)
+
+    def _cg_fit(self, X, Y, ridge, X0):
+        if self.tile_size is None:
+            K = gram(X, X, self.kernel, self.kernel_cache).to(Y.dtype)
+            row = lambda i: K[i]
+            diag = K.diagonal()
+        else:
+            K = TiledKernel(X, X, self.kernel, self.tile_size)
+            row = lambda i: gram(X[i:i + 1], X, self.kernel)[0].to(Y.dtype)
+            diag = self.kernel(X, diag=True).to(Y.dtype)
+
+        # the pivoted cholesky factor does not depend on the ridge, it is reused while X and the kernel are unchanged.
+        key = (tensor_key(X), kernel_key(self.kernel))
+        if self._pivots is None or self._pivots[0] != key:
+            self._pivots = (key, pivoted_cholesky(diag, row, self.precond_rank))
+        precond = low_rank_precond(self._pivots[1], ridge)
+        return conjugate_gradient(lambda V: K.matmul(V) + ridge*V, Y, X0, self.tol, self.max_iter, precond)
+
+    def fit(self, X, Y, ridge=None, warm_start=True):
+        """
+        solve for the coefficients of the training inputs X [N, d] and targets Y [N, C].
+        warm_start: cg starts from the previous coefficients when X is the previous training input.
+        """
+        ridge = self.ridge if ridge is None else ridge
+        solver = self.solver
+        if solver == 'auto':
+            solver = 'cholesky' if X.shape[-2] <= self.max_cholesky_size else 'cg'
+
+        if self.precision is not None:
+            X = cast(X, self.precision.kernel, self.kernel_cache)
+            Y = Y.to(self.precision.solve)
+            if solver == 'cholesky' or self.tile_size is None:
+                self.precision.check_solve(gram(X, X, self.kernel, self.kernel_cache), ridge)
+            out_dtype = None
+        else:
+            out_dtype = Y.dtype
+            Y = Y.to(torch.float64)
+
+        with torch.no_grad():
+            if solver == 'cholesky':
+                alpha = self._cholesky_fit(X, Y, ridge)
+            elif solver == 'cg':
+                reuse = warm_start and self.alpha is not None and X is self.X and self.alpha.shape == Y.shape
+                alpha = self._cg_fit(X, Y, ridge, self.alpha if reuse else None)
+            else:
+                raise ValueError('unknown solver: ' + str(solver))
+
+        self.X = X
+        self.alpha = alpha
+        self._out_dtype = out_dtype
+        return self
+
+    def forward(self, X):
+        with torch.no_grad():
+            X = cast(X, self.X.dtype)
+            if self.tile_size is not None:
+                out = TiledKernel(X, self.X, self.kernel, self.tile_size).matmul(self.alpha)
+            else:
+                out = gram(X, self.X, self.kernel).to(self.alpha.dtype).matmul(self.alpha)
+            return out if self._out_dtype is None else out.to(self._out_dtype)
+
 class DeepKernelRegression(nn.Module):
     def __init__(self, ranges, inputs, kernels, device="cpu",**kwargs):
         """
@@ -22,46 +127,332 @@ class DeepKernelRegression(nn.Module):
 
         kwargs:
             retain_layer_outputs: store the outputs of each kernel layer.
+            num_landmarks: expand every layer over only this many training points (Nyström mode),
+                           kernels become [N, num_landmarks] instead of [N, N].
+            landmark_method: 'subsample' or 'kmeans', how the landmarks are picked from the inputs.
+            seed: seed for the landmark selection.
+            kernel_cache: True (default) to keep constant gram matrices, i.e. the one of the input layer,
+                          across epochs in a KernelCache (or pass a KernelCache), False to always recompute.
+                          cached layers get no gradients for their kernel hyperparameters.
+            profiler: a profiling.LayerProfiler to instrument every layer of the forward pass.
+            num_models: train this many independent models at once (other targets, seeds or initializations),
+                        the weights get a leading model dimension [num_models, N, 1, R] and the outputs are
+                        [num_models, N, R]. the input layer kernel is shared by all of them.
+            tile_size: lazy kernel path, layers compute K @ W from [tile_size, tile_size] kernel blocks
+                       (vectorized.TiledKernel) instead of the dense N x N matrix, bypasses the kernel cache.
+            recompute: memory efficient autograd, the layer kernels are evaluated again (tile by tile) in the
+                       backward pass instead of being stored, so peak memory no longer grows with the depth.
+            grid: structured grid mode, True to detect whether the inputs are a cartesian grid (or pass its
+                  1-d axes). for factoring input kernels (polynomial, RBF) the input layer then runs through
+                  kronecker algebra (kronecker.KroneckerKernel) and keeps all grid points as its centers
+                  even with num_landmarks, so only the later layers are expanded over landmarks.
+            compile: compiled forward mode (compiled.CompiledForward), the layer stack is captured once per input
+                     shape and reused across epochs. 'auto' tries a TorchScript trace, then torch.compile and
+                     falls back to eager, 'compile' or 'trace' pick one. modes it does not cover run eagerly.
+            precision: a precision.PrecisionPolicy or the name of one ('mixed', 'float32', 'float64', 'bfloat16'),
+                       the kernels are evaluated in its kernel dtype, the weights and layer outputs are in its
+                       accumulate dtype and solve_last_layer solves in its solve dtype. without it everything
+                       is in the dtype of the inputs and the default dtype.
         """
         super(DeepKernelRegression, self).__init__()
 
         retain_layer_outputs = kwargs.get('retain_layer_outputs')
+        num_landmarks = kwargs.get('num_landmarks')
+        num_models = kwargs.get('num_models')
         self.Kernels = kernels
         self.Weights = []
         self.N  = len(inputs)
+        self.num_models = num_models
         self.Fns = []
+        self.Landmarks = [None]*len(kernels)
+
+        if num_landmarks is not None and num_landmarks < self.N:
+            # the landmarks are indices of training points, so the same indices pick the
+            # images of those points as the centers of every layer.
+            landmarks = select_landmarks(inputs, num_landmarks, kwargs.get('landmark_method', 'subsample'), kwargs.get('seed'))
+            self.Landmarks = [landmarks.to(device) for _ in kernels]
+
+        for i, kernel in enumerate(kernels):
+            if isinstance(kernel, RandomFourierFeatures):
+                # feature space layers carry one weight per feature instead of per center.
+                self.Landmarks[i] = None
+
+        grid = kwargs.get('grid')
+        self.grid_axes = None
+        if grid:
+            axes = grid_axes(inputs) if grid is True else list(grid)
+            if axes is not None and kronecker_terms(kernels[0], axes) is not None:
+                self.grid_axes = axes
+                self.Landmarks[0] = None
+            else:
+                print('grid mode: the inputs are not a grid or the input kernel does not factor, using dense kernels')
 
         # private variables
         self._ranges = ranges
         self._device = device
         self._inputs = inputs
         self._retain_layer_outputs = retain_layer_outputs
+        self._support = None
+
+        kernel_cache = kwargs.get('kernel_cache', True)
+        self.kernel_cache = KernelCache() if kernel_cache is True else (kernel_cache or None)
+        self.profiler = kwargs.get('profiler')
+        self.tile_size = kwargs.get('tile_size')
+        self.recompute = kwargs.get('recompute', False)
+        self.precision = resolve(kwargs.get('precision'))
+        kernel_dtype = None if self.precision is None else self.precision.kernel
+        weights_dtype = None if self.precision is None else self.precision.accumulate
+        if self.grid_axes is not None and kernel_dtype is not None:
+            self.grid_axes = [a.to(kernel_dtype) for a in self.grid_axes]
 
         for i, kernel in enumerate(self.Kernels):
             print(i, 'kernel', kernel, ranges[i])
-            self.Kernels[i] = kernel.to(device)
+            self.Kernels[i] = kernel.to(device=device, dtype=kernel_dtype)
             # specify weights for each layers
-            curr_Ker_weights =  torch.randn([self.N, 1, ranges[i]], requires_grad=True, device=device)
+            num_centers = self.N if self.Landmarks[i] is None else len(self.Landmarks[i])
+            if isinstance(kernel, RandomFourierFeatures):
+                num_centers = kernel.num_features
+            weights_shape = [num_centers, 1, ranges[i]] if num_models is None else [num_models, num_centers, 1, ranges[i]]
+            curr_Ker_weights =  torch.randn(weights_shape, requires_grad=True, device=device, dtype=weights_dtype)
             self.Weights.append(curr_Ker_weights)
 
+        compile_mode = kwargs.get('compile')
+        self.compiled = None if not compile_mode else compiled.CompiledForward(self, 'auto' if compile_mode is True else compile_mode)
+        self._composed = None
+
         self.layer_outputs = []
+        self.Centers = None
+        self._frozen_key = None
 
-    def forward(self, X):
+    def _init_fns(self, use_cache=True):
+        cache = self.kernel_cache if use_cache else None
         self.Fns = []
         for i, kernel in enumerate(self.Kernels):
-            # specify the function at each kernel layer.
-            curr_Ker_Fn =  fn_init(self.Kernels[i], self.Weights[i], self._ranges[i], self._device)
+            # specify the function at each kernel layer. only the input layer sees constant inputs (the training
+            # points), the inputs of the later layers change with the weights and would only pile up in the cache.
+            curr_Ker_Fn =  fn_init(self.Kernels[i], self.Weights[i], self._ranges[i], self._device, cache if i == 0 else None,
+                                   self.tile_size, self.recompute, self.precision)
             self.Fns.append(curr_Ker_Fn)
-            pass
-        self.compositeFn = compose(self.Fns, self._inputs, self._retain_layer_outputs)
-        final_output, all_layers_outputs = self.compositeFn(X)
+        if self.grid_axes is not None:
+            self.Fns[0] = kronecker_fn(self.Kernels[0], self.Weights[0], self._inputs, self.grid_axes, self.Fns[0])
+        return self.Fns
+
+    def forward(self, X):
+        if self.compiled is not None and compiled.supported(self, X):
+            self.layer_outputs = []
+            return self.compiled(X)
+
+        # the closures only change with the weight tensors, landmarks or options, not from epoch to epoch.
+        key = (tuple(id(w) for w in self.Weights), tuple(id(k) for k in self.Kernels), tuple(id(lm) for lm in self.Landmarks),
+               id(self._inputs), self.tile_size, self.recompute, self.grid_axes is None, self._retain_layer_outputs, id(self.profiler), id(self.kernel_cache))
+        if self._composed is None or self._composed[0] != key:
+            self._init_fns()
+            self.compositeFn = compose(self.Fns, self._inputs, self._retain_layer_outputs, self.Landmarks, self.kernel_cache, self.profiler)
+            self._composed = (key, self.compositeFn)
+        final_output, all_layers_outputs = self._composed[1](X)
 
         self.layer_outputs = all_layers_outputs
         return final_output
 
+    def forward_rows(self, rows):
+        """
+        evaluate the model at the training rows `rows` (mini-batch step).
+
+        only the rows that are centers of some layer (the union of the landmarks) are propagated
+        along with the batch, so with landmarks a step costs [batch, M] + [M, M] kernels per layer
+        instead of [N, N]. a layer expanded over all training points (no landmarks) would propagate the
+        whole set at every step, more work than a full batch step, and raises a ValueError.
+        """
+        support, positions = self._support_rows()
+        # the batch changes every step, only the kernels of the support are worth caching.
+        batch_fns = self._init_fns(use_cache=False)
+        support_fns = self._init_fns()
+
+        prev_val = self._inputs.index_select(-2, rows)
+        prev_support = support
+        for i, (batch_fn, support_fn, pos) in enumerate(zip(batch_fns, support_fns, positions)):
+            centers = select_centers(prev_support, pos, self.kernel_cache if i == 0 else None)
+            prev_val = batch_fn(prev_val, centers)
+            if i < len(support_fns) - 1:
+                prev_support = support_fn(prev_support, centers)
+
+        return prev_val
+
+    def _support_rows(self):
+        """
+        training rows that are centers of some layer and the positions of each layers landmarks among them.
+        """
+        key = tuple(id(lm) for lm in self.Landmarks)
+        if self._support is not None and self._support[0] == key:
+            return self._support[1:]
+
+        expanded = [not isinstance(kernel, RandomFourierFeatures) for kernel in self.Kernels]
+        landmarks = [lm for lm in self.Landmarks if lm is not None]
+        if any(is_expanded and lm is None for is_expanded, lm in zip(expanded, self.Landmarks)):
+            raise ValueError('mini-batch steps need landmarks (num_landmarks) or features on every layer, '
+                             'a layer expanded over all training points propagates all of them at every step')
+        if len(landmarks) > 0:
+            support_idx = torch.cat(landmarks).unique()
+            support = self._inputs.index_select(-2, support_idx)
+            positions = [None if lm is None else torch.searchsorted(support_idx, lm) for lm in self.Landmarks]
+        else:
+            support = self._inputs[:0]
+            positions = self.Landmarks
+
+        self._support = (key, support, positions)
+        return support, positions
+
+    def add_points(self, X_new):
+        """
+        append new training points to the representer set.
+
+        the layers expanded over all points get a zero weight row per new point, so the model function is
+        unchanged (a warm start for fine tuning), landmark and feature layers keep their weights. the cached
+        input layer kernel is extended by the blocks of the new rows instead of being recomputed.
+        """
+        X_new = X_new.to(self._inputs.device, self._inputs.dtype)
+        old_inputs = self._inputs
+        self._inputs = torch.cat([old_inputs, X_new], -2)
+        self.N = len(self._inputs)
+
+        kernel, landmarks = self.Kernels[0], self.Landmarks[0]
+        if self.kernel_cache is not None and not isinstance(kernel, RandomFourierFeatures):
+            if landmarks is None:
+                self.kernel_cache.extend(old_inputs, old_inputs, self._inputs, self._inputs, kernel, gram)
+            else:
+                old_centers = select_centers(old_inputs, landmarks, self.kernel_cache)
+                centers = select_centers(self._inputs, landmarks, self.kernel_cache)
+                self.kernel_cache.extend(old_inputs, old_centers, self._inputs, centers, kernel, gram)
+
+        for i, kernel in enumerate(self.Kernels):
+            if self.Landmarks[i] is not None or isinstance(kernel, RandomFourierFeatures):
+                continue
+            W = self.Weights[i].detach()
+            zeros = W.new_zeros([*W.shape[:-3], len(X_new), *W.shape[-2:]])
+            self.Weights[i] = torch.cat([W, zeros], -3).requires_grad_()
+
+        if self.grid_axes is not None:
+            print('add_points: the inputs are no longer a grid, the input layer kernel is evaluated densely')
+            self.grid_axes = None
+        self._support = None
+        self.Centers = None
+        return self
+
+    def solve_last_layer(self, X, Y, ridge=1e-3, solver='cholesky'):
+        """
+        variable projection step: for the current inner layers, solve the kernel ridge problem
+        of the last layer in closed form, write the solution into its weights and return the prediction.
+
+        the prediction stays attached to the graph of the inner layers, while the solved weights are
+        treated as constants (at the optimum their gradient vanishes).
+        """
+        fns = self._init_fns()
+        solve_dtype = None if self.precision is None else self.precision.solve
+        if len(fns) == 1 and self.grid_axes is not None and X is self._inputs:
+            # single layer on the grid, (K + λI) W = Y through the kronecker factors.
+            with torch.no_grad():
+                axes = [cast(a, solve_dtype) for a in self.grid_axes]
+                W = KroneckerKernel.from_grid(self.Kernels[0], axes).solve(cast(Y, solve_dtype), ridge)
+                self.Weights[0].copy_(W.reshape(self.Weights[0].shape))
+            out = fns[0](X, X)
+            self.layer_outputs = [out] if self._retain_layer_outputs else []
+            return out
+
+        prev_val, layer_outputs = realize_composite_fns(fns[:-1], self._inputs, X, self._retain_layer_outputs, self.Landmarks[:-1],
+                                                        self.kernel_cache, self.profiler)
+        kernel, landmarks = self.Kernels[-1], self.Landmarks[-1]
+        # the inputs of the last layer are only constant when it is the input layer.
+        cache = self.kernel_cache if len(fns) == 1 else None
+
+        if isinstance(kernel, RandomFourierFeatures):
+            A = kernel.features(prev_val if self.precision is None else prev_val.to(self.precision.kernel))
+            reg = None
+        else:
+            centers = select_centers(prev_val, landmarks, cache)
+            if self.precision is not None:
+                prev_val, centers = self.precision.kernel_inputs(prev_val, centers, cache)
+            A = gram(prev_val, centers, kernel, cache)
+            reg = 'square' if landmarks is None else gram(centers, centers, kernel, cache)
+
+        with torch.no_grad():
+            A_ = cast(A.detach(), solve_dtype)
+            Y_ = cast(Y, solve_dtype)
+            eye = torch.eye(A_.shape[-1], dtype=A_.dtype, device=A_.device)
+            if isinstance(reg, str):
+                # (K + λI) W = Y
+                system, rhs = A_ + ridge*eye, Y_
+            else:
+                # (AᵀA + λR) W = AᵀY with R = K(Z, Z) for landmarks and I for features.
+                reg = eye if reg is None else cast(reg.detach(), solve_dtype)
+                system, rhs = A_.transpose(-1, -2).matmul(A_) + ridge*reg, A_.transpose(-1, -2).matmul(Y_)
+            if self.precision is not None:
+                self.precision.check_solve(system, key='solve_last_layer')
+            W = solve_spd(system, rhs, solver)
+            self.Weights[-1].copy_(W.reshape(self.Weights[-1].shape))
+
+        out = A.to(self.Weights[-1].dtype).matmul(self.Weights[-1].detach().squeeze(-2))
+        self.layer_outputs = layer_outputs + [out] if self._retain_layer_outputs else []
+        return out
+
     def parameters(self):
         return self.Weights
 
     def load_params(self, new_weights):
         self.Weights = new_weights
+        self.Centers = None
+
+    def _centers_key(self):
+        # optimizer steps and copy_ bump the version of the weights, load_params / add_points / compress replace them.
+        return (tuple((id(w), w._version) for w in self.Weights), tuple(id(lm) for lm in self.Landmarks),
+                id(self._inputs), tuple(kernel_key(k) for k in self.Kernels))
+
+    def freeze(self):
+        """
+        cache the image of the training inputs at the input of every layer.
+        these are the representer points used by `predict`, which freezes again
+        by itself once the weights, landmarks or kernels changed.
+        """
+        self._frozen_key = self._centers_key()
+        with torch.no_grad():
+            fns = self._init_fns()
+            prev_val = self._inputs.to(self._device)
+            self.Centers = []
+            for i, (curr_fn, landmarks) in enumerate(zip(fns, self.Landmarks)):
+                centers = select_centers(prev_val, landmarks, self.kernel_cache if i == 0 else None)
+                self.Centers.append(centers)
+                prev_val = curr_fn(prev_val, centers)
+        return self.Centers
+
+    def predict(self, X_new, batch_size=1024):
+        """
+        evaluate the trained model at new points against the frozen centers,
+        one cross kernel [batch_size, N] ([batch_size, num_landmarks]) per layer per batch.
+        """
+        if self.Centers is None or self._frozen_key != self._centers_key():
+            self.freeze()
+
+        fns = self._init_fns(use_cache=False)
+        preds = []
+        with torch.no_grad():
+            for X_batch in torch.split(X_new.to(self._device), batch_size):
+                preds.append(realize_composite_fns_at(fns, self.Centers, X_batch))
+        return torch.cat(preds, -2)
+
+class VariableProjection:
+    def __init__(self, model, Y, ridge=1e-3, solver='cholesky'):
+        """
+        the model as train_loop sees it in variable projection training: calling it solves the last layer
+        of `model` for the targets Y (DeepKernelRegression.solve_last_layer) and returns the prediction.
+        any other attribute (layer_outputs, profiler, ...) is the one of the model, so callbacks and the
+        profiler see the real model.
+        """
+        self.__dict__.update(model=model, Y=Y, ridge=ridge, solver=solver)
+
+    def __call__(self, X):
+        return self.model.solve_last_layer(X, self.Y, self.ridge, self.solver)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
 
+    def __setattr__(self, name, value):
+        setattr(self.model, name, value)
@@ -0,0 +1,148 @@
+"""
+post training compression of DeepKernelRegression: shrink the set of centers every layer is expanded over.
+
+layer by layer the centers are ranked by their contribution ||K(P, c_j)|| * ||w_j|| to the layer output
+at the training inputs P, and the smallest prefix of that ranking whose least squares refit of the weights
+reproduces the original layer output within `tol` (relative) is kept. the refit moves the contribution of
+the dropped centers onto the kept ones, and as every layer is refitted to the original outputs on the
+already compressed inputs, the error of earlier layers is compensated instead of accumulated.
+the kept centers become the layer landmarks, so prediction cost scales with them instead of N.
+"""
+import time
+import torch
+import torch.nn as nn
+from rff import RandomFourierFeatures
+from solvers import cholesky_solve
+from utils import train_loop
+from vectorized import gram, select_centers
+
+def _layer_outputs(model):
+    # input of every layer at the training rows, followed by the model output.
+    with torch.no_grad():
+        prev_val = model._inputs
+        images = []
+        for fn, landmarks in zip(model._init_fns(use_cache=False), model.Landmarks):
+            images.append(prev_val)
+            prev_val = fn(prev_val, select_centers(prev_val, landmarks))
+        images.append(prev_val)
+    return images
+
+def _refit(A, T, ridge=1e-10):
+    # least squares weights of T ≈ A @ W through the (slightly regularized) normal equations.
+    AtA = A.transpose(-1, -2).matmul(A)
+    reg = ridge*AtA.diagonal(dim1=-2, dim2=-1).mean().clamp(min=1e-30)
+    eye = torch.eye(AtA.shape[-1], dtype=A.dtype, device=A.device)
+    return cholesky_solve(AtA + reg*eye, A.transpose(-1, -2).matmul(T))
+
+def _merge(centers, positions, W, merge_tol):
+    # centers closer than merge_tol (same cell of a merge_tol grid) are replaced by one of them with the summed weight.
+    cells = torch.round(centers / merge_tol)
+    _, inverse = torch.unique(cells, dim=0, return_inverse=True)
+    groups = int(inverse.max()) + 1
+    # the first member of every group: sort by (group, index), the keys are unique so the order is deterministic.
+    n = len(positions)
+    order = (inverse*n + torch.arange(n, device=inverse.device)).argsort()
+    counts = torch.bincount(inverse, minlength=groups)
+    first = order[torch.cumsum(counts, 0) - counts]
+    merged = torch.zeros([*W.shape[:-2], groups, W.shape[-1]], dtype=W.dtype, device=W.device).index_add(-2, inverse, W)
+    return positions[first], merged
+
+def compress_layer(kernel, P, positions, W, T, tol, merge_tol=None):
+    """
+    smallest set of centers (row indices `positions` of P) whose refitted weights give K(P, P[kept]) @ W' ≈ T
+    within the relative error tol. returns the kept positions, their weights and the error.
+    """
+    if merge_tol is not None and P.dim() == 2:
+        positions, W = _merge(P.index_select(-2, positions), positions, W, merge_tol)
+
+    K = gram(P, P.index_select(-2, positions), kernel).to(W.dtype)
+    contribution = K.norm(dim=-2) * W.norm(dim=-1)
+    while contribution.dim() > 1:
+        contribution = contribution.norm(dim=0)
+    order = contribution.argsort(descending=True)
+
+    T_norm = T.norm().clamp(min=1e-30)
+    def fit(k):
+        kept = order[:k].sort().values
+        A = K.index_select(-1, kept)
+        W_k = _refit(A, T)
+        return kept, W_k, ((A.matmul(W_k) - T).norm() / T_norm).item()
+
+    # the refit error does not grow with the number of kept centers, binary search the smallest count.
+    # if even all centers miss tol (errors of earlier layers), their error is the target.
+    target = max(tol, fit(len(order))[2]*(1 + 1e-6))
+    low, high = 1, len(order)
+    while low < high:
+        k = (low + high) // 2
+        if fit(k)[2] <= target:
+            high = k
+        else:
+            low = k + 1
+    kept, W_k, error = fit(low)
+    return positions[kept], W_k, error
+
+def predict_time(model, X, repeats=3):
+    model.freeze()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.predict(X)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def compress(model, tol=1e-2, merge_tol=None, data_y=None, fine_tune_epochs=0, learning_rate=0.0005, X_eval=None):
+    """
+    compress every kernel layer of a trained model in place (feature layers are kept as they are).
+
+    tol: relative error allowed in the output of every layer at the training inputs.
+    merge_tol: if set, centers whose layer inputs are closer than this are merged into one before pruning.
+    data_y: training targets, used for the accuracy report and to fine-tune the compressed model
+            for `fine_tune_epochs` epochs.
+    X_eval: points to time the prediction at, defaults to the training inputs.
+
+    returns a report with the centers per layer before and after, the speedup and the accuracy loss.
+    """
+    X_eval = model._inputs if X_eval is None else X_eval
+    time_before = predict_time(model, X_eval)
+    original = _layer_outputs(model)
+    N = model._inputs.shape[-2]
+
+    layers = []
+    for i, kernel in enumerate(model.Kernels):
+        if isinstance(kernel, RandomFourierFeatures):
+            continue
+        P = _layer_outputs(model)[i]
+        landmarks = model.Landmarks[i]
+        positions = torch.arange(N, device=P.device) if landmarks is None else landmarks
+        W = model.Weights[i].detach().squeeze(-2)
+        with torch.no_grad():
+            kept, W_kept, error = compress_layer(kernel, P, positions, W, original[i + 1], tol, merge_tol)
+
+        model.Landmarks[i] = kept
+        model.Weights[i] = W_kept.unsqueeze(-2).clone().requires_grad_()
+        if i == 0:
+            # the kronecker path needs all grid points as centers.
+            model.grid_axes = None
+        layers.append(dict(layer=i, centers_before=len(positions), centers_after=len(kept), error=error))
+
+    model._support = None
+    model.Centers = None
+
+    if fine_tune_epochs > 0 and data_y is not None:
+        optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate, weight_decay=1e-5)
+        train_loop(model._inputs, data_y, model, nn.MSELoss(), optimizer, fine_tune_epochs)
+
+    time_after = predict_time(model, X_eval)
+    compressed = _layer_outputs(model)[-1]
+    report = dict(layers=layers, predict_s_before=time_before, predict_s_after=time_after, speedup=time_before / time_after,
+                  output_error=((compressed - original[-1]).norm() / original[-1].norm().clamp(min=1e-30)).item())
+    if data_y is not None:
+        report['mse_before'] = ((original[-1] - data_y)**2).mean().item()
+        report['mse_after'] = ((compressed - data_y)**2).mean().item()
+
+    for layer in layers:
+        print(f"layer {layer['layer']}: {layer['centers_before']} -> {layer['centers_after']} centers, relative error {layer['error']:.2e}")
+    print(f"predict x{report['speedup']:.2f} faster, relative output change {report['output_error']:.2e}")
+    if data_y is not None:
+        print(f"mse {report['mse_before']:.4g} -> {report['mse_after']:.4g}")
+    return report
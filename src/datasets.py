@@ -0,0 +1,68 @@
+import os
+import numpy as np
+import torch
+
+# test functions of section 4.2 of the paper, vectorized over the rows of x ([N, d], the first two coordinates are used).
+def h1(x):
+    return (0.1 + np.abs(x[:, 0] - x[:, 1]))**(-1)
+
+def h2(x):
+    return (x[:, 0]*x[:, 1] > 3/20)*1.0
+
+def design_chunk(design, num_points, dim, start, stop, domain=(-1, 1), seed=0):
+    """
+    rows [start, stop) of the input design.
+
+    grid: cartesian grid with `num_points` per axis (num_points**dim rows), the last axis varies fastest.
+    random: num_points uniform samples, every chunk is seeded by its offset so chunks are reproducible.
+    """
+    low, high = domain
+    rows = np.arange(start, stop)
+    if design == 'grid':
+        axis = np.linspace(low, high, num_points, dtype=np.float32)
+        idx = np.stack(np.unravel_index(rows, [num_points]*dim), 1)
+        return axis[idx]
+    if design == 'random':
+        rng = np.random.default_rng([seed, start])
+        return rng.uniform(low, high, [len(rows), dim]).astype(np.float32)
+    raise ValueError('unknown design: ' + str(design))
+
+def generate_dataset(num_points, dim=2, design='grid', fns=(h1, h2), path=None, chunk_size=2**16, domain=(-1, 1), seed=0):
+    """
+    create inputs x [N, dim] and targets y [N, len(fns)] chunk by chunk.
+
+    if `path` is given the dataset is written to path/x.npy and path/y.npy and returned memory mapped
+    (see load_dataset), so it never has to be held in memory as a whole.
+    """
+    N = num_points**dim if design == 'grid' else num_points
+
+    if path is None:
+        x = np.empty([N, dim], dtype=np.float32)
+        y = np.empty([N, len(fns)], dtype=np.float32)
+    else:
+        os.makedirs(path, exist_ok=True)
+        x = np.lib.format.open_memmap(os.path.join(path, 'x.npy'), mode='w+', dtype=np.float32, shape=(N, dim))
+        y = np.lib.format.open_memmap(os.path.join(path, 'y.npy'), mode='w+', dtype=np.float32, shape=(N, len(fns)))
+
+    for start in range(0, N, chunk_size):
+        stop = min(start + chunk_size, N)
+        x_chunk = design_chunk(design, num_points, dim, start, stop, domain, seed)
+        x[start:stop] = x_chunk
+        for i, fn in enumerate(fns):
+            y[start:stop, i] = fn(x_chunk)
+
+    if path is None:
+        return torch.from_numpy(x), torch.from_numpy(y)
+    x.flush()
+    y.flush()
+    del x, y
+    return load_dataset(path)
+
+def load_dataset(path):
+    """
+    memory mapped (copy on write) x, y tensors of a dataset written by generate_dataset,
+    rows are only read from disk when they are indexed.
+    """
+    x = np.load(os.path.join(path, 'x.npy'), mmap_mode='c')
+    y = np.load(os.path.join(path, 'y.npy'), mmap_mode='c')
+    return torch.from_numpy(x), torch.from_numpy(y)
@@ -0,0 +1,175 @@
+"""
+data parallel training of DeepKernelRegression over row shards with torch.distributed (gloo).
+
+every process holds the full (identically initialized) model and computes the rows of every layer
+that belong to its shard, the layer outputs are all-gathered so the next layer sees all its centers.
+the loss of every shard is backpropagated locally and the weight gradients are all-reduced.
+"""
+import queue as queue_module
+import socket
+import time
+import traceback
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from utils import init_rls2_model
+from vectorized import select_centers
+
+def shard_bounds(N, rank, world_size):
+    size = (N + world_size - 1) // world_size
+    return min(rank*size, N), min((rank + 1)*size, N)
+
+class AllGatherRows(torch.autograd.Function):
+    """
+    concatenate the row shards of all processes, in backward the gradient of the full tensor is
+    summed over the processes (every process used all rows) and each one keeps its own rows.
+    """
+    @staticmethod
+    def forward(ctx, shard, N):
+        world_size, rank = dist.get_world_size(), dist.get_rank()
+        size = (N + world_size - 1) // world_size
+        ctx.bounds = shard_bounds(N, rank, world_size)
+        # gloo needs equally sized buffers, the last shard is padded.
+        padded = shard.new_zeros([*shard.shape[:-2], size, shard.shape[-1]])
+        padded[..., :shard.shape[-2], :] = shard
+        buffers = [torch.empty_like(padded) for _ in range(world_size)]
+        dist.all_gather(buffers, padded.contiguous())
+        return torch.cat(buffers, -2)[..., :N, :]
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.contiguous()
+        dist.all_reduce(grad)
+        start, stop = ctx.bounds
+        return grad[..., start:stop, :], None
+
+def forward_sharded(model, X):
+    """
+    the model output at this process' rows of X, every layer only evaluates [shard, centers] kernels.
+    """
+    N = X.shape[-2]
+    start, stop = shard_bounds(N, dist.get_rank(), dist.get_world_size())
+    fns = model._init_fns()
+    prev_val = X
+    for i, (curr_fn, landmarks) in enumerate(zip(fns, model.Landmarks)):
+        centers = select_centers(prev_val, landmarks, model.kernel_cache if i == 0 else None)
+        shard = curr_fn(prev_val[..., start:stop, :], centers)
+        if i == len(fns) - 1:
+            return shard
+        prev_val = AllGatherRows.apply(shard, N)
+
+def _worker(rank, world_size, port, data_x, data_y, ranges, degree, num_epochs, learning_rate, threads, seed, model_kwargs, queue, received):
+    try:
+        _train_worker(rank, world_size, port, data_x, data_y, ranges, degree, num_epochs, learning_rate, threads, seed, model_kwargs, queue, received)
+    except Exception:
+        # the parent raises it, the other processes are terminated (they would wait in a collective).
+        queue.put(dict(error=traceback.format_exc(), rank=rank))
+        raise
+
+def _train_worker(rank, world_size, port, data_x, data_y, ranges, degree, num_epochs, learning_rate, threads, seed, model_kwargs, queue, received):
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:' + str(port), rank=rank, world_size=world_size)
+    torch.set_num_threads(threads)
+    # the same seed on every process gives every process the same initial weights and landmarks.
+    torch.manual_seed(seed)
+    model = init_rls2_model(ranges, data_x, degree, 'cpu', **model_kwargs)
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate, weight_decay=1e-5)
+
+    N = data_x.shape[-2]
+    start, stop = shard_bounds(N, rank, world_size)
+    y_shard = data_y[..., start:stop, :]
+    history = torch.zeros(num_epochs)
+
+    dist.barrier()
+    begin = time.perf_counter()
+    for epoch in range(num_epochs):
+        optimizer.zero_grad()
+        pred = forward_sharded(model, data_x)
+        # the shard losses add up to the MSE over all rows (summed over the models of a batch, see batched_mse_loss).
+        loss = ((pred - y_shard)**2).sum() / (data_y.shape[-2]*data_y.shape[-1])
+        loss.backward()
+        for w in model.parameters():
+            dist.all_reduce(w.grad)
+        optimizer.step()
+
+        total_loss = loss.detach().clone()
+        dist.all_reduce(total_loss)
+        history[epoch] = total_loss
+    elapsed = time.perf_counter() - begin
+
+    if rank == 0:
+        queue.put(dict(weights=[w.detach().clone() for w in model.parameters()], landmarks=model.Landmarks,
+                       kernels=[kernel.state_dict() for kernel in model.Kernels], loss_history=history, time=elapsed))
+        # the tensors are shared with the parent through this process, it has to outlive the transfer.
+        received.wait()
+    dist.barrier()
+    dist.destroy_process_group()
+
+def _wait_result(queue, processes, poll_s=1.0):
+    # the result of rank 0, or the error of the first worker that failed (or died without reporting one).
+    while True:
+        try:
+            result = queue.get(timeout=poll_s)
+        except queue_module.Empty:
+            failed = [(rank, p.exitcode) for rank, p in enumerate(processes) if p.exitcode not in (None, 0)]
+            if not failed:
+                continue
+            try:
+                # a worker that raised reports its traceback before it exits.
+                result = queue.get(timeout=poll_s)
+            except queue_module.Empty:
+                result = dict(error='exit code ' + str(failed[0][1]), rank=failed[0][0])
+        if 'error' not in result:
+            return result
+        for p in processes:
+            p.terminate()
+            p.join()
+        raise RuntimeError('distributed training failed in worker ' + str(result['rank']) + ':\n' + result['error'])
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def train_distributed(data_x, data_y, ranges, degree, world_size=2, num_epochs=100, learning_rate=0.0005, threads_per_process=1, seed=0, **model_kwargs):
+    """
+    train the model of init_rls2_model with `world_size` local cpu processes.
+    model_kwargs go to init_rls2_model (e.g. num_landmarks, num_features).
+
+    returns the trained model (in this process) with `loss_history` and `epochs_per_s` set.
+    """
+    ctx = mp.get_context('spawn')
+    queue, received = ctx.Queue(), ctx.Event()
+    port = _free_port()
+    data_x, data_y = data_x.cpu(), data_y.cpu()
+    args = (world_size, port, data_x, data_y, ranges, degree, num_epochs, learning_rate, threads_per_process, seed, model_kwargs, queue, received)
+    processes = [ctx.Process(target=_worker, args=(rank,) + args) for rank in range(world_size)]
+    for p in processes:
+        p.start()
+    result = _wait_result(queue, processes)
+    received.set()
+    for p in processes:
+        p.join()
+
+    torch.manual_seed(seed)
+    model = init_rls2_model(ranges, data_x, degree, 'cpu', **model_kwargs)
+    for kernel, kernel_state in zip(model.Kernels, result['kernels']):
+        kernel.load_state_dict(kernel_state)
+    model.Landmarks = result['landmarks']
+    model.load_params([w.requires_grad_() for w in result['weights']])
+    model.freeze()
+    model.loss_history = result['loss_history']
+    model.epochs_per_s = num_epochs / result['time']
+    return model
+
+def scaling_report(data_x, data_y, ranges, degree, core_counts=(1, 2, 4), num_epochs=20, **model_kwargs):
+    """
+    training throughput for every number of single threaded processes in `core_counts`.
+    """
+    rows = []
+    for world_size in core_counts:
+        model = train_distributed(data_x, data_y, ranges, degree, world_size, num_epochs, **model_kwargs)
+        rows.append(dict(processes=world_size, epochs_per_s=model.epochs_per_s))
+    for row in rows:
+        print(f"{row['processes']:>3} processes  {row['epochs_per_s']:>8.2f} epochs/s  "
+              f"speedup x{row['epochs_per_s'] / rows[0]['epochs_per_s']:.2f}")
+    return rows
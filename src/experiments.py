@@ -0,0 +1,101 @@
+import time
+import multiprocessing as mp
+import torch
+import gpytorch as gpy
+from compositeKRR import SingleLayerKRR
+from utils import e2eKRR, e2eSKRR, createSyntheticData, init_rls2_model
+
+def config_name(config):
+    name = config['model'] + '_' + config['target']
+    if config['model'] == 'e2eKRR':
+        name += '_p' + str(config['degree'])
+    return name + '_s' + str(config.get('seed', 0))
+
+def fig3_configs(num_data_points=5, num_epochs=10000, seeds=(0,), **kwargs):
+    """
+    the six independent fits behind figure 3 (e2eKRR for degree 1 and 2 and e2eSKRR, for h1 and h2) for every seed.
+    extra kwargs are passed on to e2eKRR.
+    """
+    configs = []
+    for seed in seeds:
+        for target in ['h1', 'h2']:
+            for degree in [1, 2]:
+                configs.append(dict(model='e2eKRR', target=target, degree=degree, seed=seed,
+                                    num_data_points=num_data_points, num_epochs=num_epochs, kwargs=kwargs))
+            configs.append(dict(model='e2eSKRR', target=target, seed=seed,
+                                num_data_points=num_data_points, num_epochs=num_epochs))
+    return configs
+
+def _init_worker(threads_per_worker):
+    torch.set_num_threads(threads_per_worker)
+
+def run_config(config):
+    """
+    train a single configuration on cpu, returns its weights and loss history as cpu tensors.
+    """
+    torch.manual_seed(config.get('seed', 0))
+    _,ranges,data_x,data_y_h1, data_y_h2 = createSyntheticData(config['num_data_points'])
+    data_y = data_y_h1 if config['target'] == 'h1' else data_y_h2*1.0
+
+    start = time.time()
+    if config['model'] == 'e2eKRR':
+        model = e2eKRR(data_x, data_y, ranges, config['degree'], 'cpu', config['num_epochs'], **config.get('kwargs', {}))
+        state = dict(weights=[w.detach().cpu() for w in model.parameters()], landmarks=model.Landmarks,
+                     kernels=[kernel.state_dict() for kernel in model.Kernels])
+        loss_history = model.loss_history.cpu()
+    else:
+        model = e2eSKRR(data_x, data_y, 'cpu', config['num_epochs'])
+        state = dict(state_dict=model.state_dict())
+        loss_history = model.loss_history.cpu()
+
+    return dict(name=config_name(config), config=config, state=state, loss_history=loss_history, time=time.time() - start)
+
+def run_experiments(configs, num_workers=None, threads_per_worker=1, result_path=None):
+    """
+    run independent configurations across a process pool, every worker is limited to
+    `threads_per_worker` torch threads. the longest runs (epochs * points^4) are started first.
+
+    returns the result store, a dict config name -> result of run_config, optionally saved to `result_path`.
+    """
+    if num_workers is None:
+        num_workers = max(mp.cpu_count() // threads_per_worker, 1)
+    cost = lambda config: config['num_epochs'] * config['num_data_points']**4
+    configs = sorted(configs, key=cost, reverse=True)
+
+    results = {}
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(num_workers, initializer=_init_worker, initargs=(threads_per_worker,)) as pool:
+        for result in pool.imap_unordered(run_config, configs, chunksize=1):
+            print('finished ', result['name'], ' in ', result['time'], 's')
+            results[result['name']] = result
+
+    if result_path is not None:
+        torch.save(results, result_path)
+    return results
+
+def load_results(result_path):
+    return torch.load(result_path)
+
+def model_from_result(result, device='cpu'):
+    """
+    rebuild the trained model of a result on `device`.
+    """
+    config = result['config']
+    _,ranges,data_x,data_y_h1, data_y_h2 = createSyntheticData(config['num_data_points'])
+    data_x = data_x.to(device)
+
+    if config['model'] == 'e2eKRR':
+        kwargs = config.get('kwargs', {})
+        model = init_rls2_model(ranges, data_x, config['degree'], device, num_features=kwargs.get('num_features'))
+        for kernel, kernel_state in zip(model.Kernels, result['state']['kernels']):
+            kernel.load_state_dict(kernel_state)
+        model.Landmarks = [None if lm is None else lm.to(device) for lm in result['state']['landmarks']]
+        model.load_params([w.to(device).requires_grad_() for w in result['state']['weights']])
+        model.freeze()
+        return model
+
+    data_y = data_y_h1 if config['target'] == 'h1' else data_y_h2*1.0
+    likelihood = gpy.likelihoods.GaussianLikelihood()
+    model = SingleLayerKRR(data_x, data_y.squeeze(1).to(device), likelihood).to(device)
+    model.load_state_dict(result['state']['state_dict'])
+    return model
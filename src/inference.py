@@ -0,0 +1,126 @@
+"""
+frozen inference artifacts of trained DeepKernelRegression models.
+
+an artifact is a directory with a manifest.json (format version, kernel types and hyperparameters
+of every layer) and one float32 .npy file per array (the centers and weights of every layer, the
+frequencies of feature layers). loading it only needs numpy, the arrays are memory mapped so a
+serving process starts without reading (or importing) the training stack.
+"""
+import json
+import os
+import numpy as np
+
+FORMAT = 'deep-kernel-regression'
+VERSION = 1
+
+def _array(t):
+    return t.detach().cpu().numpy().astype(np.float32)
+
+def _kernel_spec(kernel):
+    name = type(kernel).__name__
+    if name == 'ScaleKernel':
+        return dict(type='scale', outputscale=float(kernel.outputscale), base=_kernel_spec(kernel.base_kernel))
+    if name == 'PolynomialKernel':
+        return dict(type='polynomial', power=int(kernel.power), offset=float(kernel.offset))
+    if name == 'RBFKernel':
+        return dict(type='rbf', lengthscale=_array(kernel.lengthscale).reshape(-1).tolist())
+    if name == 'MaternKernel':
+        return dict(type='matern', nu=float(kernel.nu), lengthscale=_array(kernel.lengthscale).reshape(-1).tolist())
+    if name == 'RandomFourierFeatures':
+        return dict(type='rff', num_features=int(kernel.num_features))
+    raise ValueError('kernel can not be exported: ' + name)
+
+def export_artifact(model, path):
+    """
+    freeze a trained DeepKernelRegression into the artifact directory `path`.
+    """
+    os.makedirs(path, exist_ok=True)
+    centers = model.freeze()
+
+    def save(name, t):
+        np.save(os.path.join(path, name + '.npy'), _array(t))
+        return name + '.npy'
+
+    layers = []
+    for i, (kernel, weights, layer_centers) in enumerate(zip(model.Kernels, model.Weights, centers)):
+        spec = _kernel_spec(kernel)
+        layer = dict(kernel=spec, weights=save('layer_' + str(i) + '_weights', weights.squeeze(-2)))
+        if spec['type'] == 'rff':
+            layer['omega'] = save('layer_' + str(i) + '_omega', kernel.omega)
+            layer['bias'] = save('layer_' + str(i) + '_bias', kernel.bias)
+        else:
+            layer['centers'] = save('layer_' + str(i) + '_centers', layer_centers)
+        layers.append(layer)
+
+    manifest = dict(format=FORMAT, version=VERSION, dtype='float32', num_models=model.num_models,
+                    input_dim=int(model._inputs.shape[-1]), output_dim=int(model.Weights[-1].shape[-1]), layers=layers)
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    print('artifact exported to ', path)
+    return manifest
+
+def _sq_dist(x1, x2):
+    x1_sq = (x1**2).sum(-1)[..., :, None]
+    x2_sq = (x2**2).sum(-1)[..., None, :]
+    return np.maximum(x1_sq + x2_sq - 2*x1 @ np.swapaxes(x2, -1, -2), 0)
+
+def kernel_matrix(spec, x1, x2):
+    """
+    numpy version of the exported gpytorch kernels.
+    """
+    kind = spec['type']
+    if kind == 'scale':
+        return spec['outputscale']*kernel_matrix(spec['base'], x1, x2)
+    if kind == 'polynomial':
+        return (x1 @ np.swapaxes(x2, -1, -2) + spec['offset'])**spec['power']
+    lengthscale = np.asarray(spec['lengthscale'], dtype=x1.dtype)
+    d2 = _sq_dist(x1 / lengthscale, x2 / lengthscale)
+    if kind == 'rbf':
+        return np.exp(-0.5*d2)
+    if kind == 'matern':
+        d = np.sqrt(d2)
+        nu = spec['nu']
+        exp_component = np.exp(-np.sqrt(2*nu)*d)
+        if nu == 0.5:
+            return exp_component
+        if nu == 1.5:
+            return (1 + np.sqrt(3)*d)*exp_component
+        return (1 + np.sqrt(5)*d + 5/3*d2)*exp_component
+    raise ValueError('unknown kernel type: ' + kind)
+
+class FrozenModel:
+    def __init__(self, path, mmap=True):
+        """
+        numpy inference of an artifact written by export_artifact, with `mmap` the arrays are memory mapped.
+        """
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('format') != FORMAT or self.manifest.get('version', 0) > VERSION:
+            raise ValueError('unsupported artifact: ' + str(self.manifest.get('format')) + ' v' + str(self.manifest.get('version')))
+
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode='r' if mmap else None)
+        self.layers = []
+        for layer in self.manifest['layers']:
+            arrays = {key: load(layer[key]) for key in ['weights', 'centers', 'omega', 'bias'] if key in layer}
+            self.layers.append((layer['kernel'], arrays))
+
+    def _forward(self, val):
+        for spec, arrays in self.layers:
+            if spec['type'] == 'rff':
+                phi = np.sqrt(2.0 / spec['num_features'])*np.cos(val @ arrays['omega'] + arrays['bias'])
+                val = phi @ arrays['weights']
+            else:
+                val = kernel_matrix(spec, val, arrays['centers']) @ arrays['weights']
+        return val
+
+    def predict(self, X, batch_size=1024):
+        """
+        model output at X [n, input_dim], computed `batch_size` rows at a time.
+        """
+        X = np.asarray(X, dtype=np.float32)
+        return np.concatenate([self._forward(X[i:i + batch_size]) for i in range(0, len(X), batch_size)], -2)
+
+    __call__ = predict
+
+def load_artifact(path, mmap=True):
+    return FrozenModel(path, mmap)
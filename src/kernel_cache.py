@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import torch
+from solvers import jittered_cholesky
+
+def tensor_key(t):
+    return (t.data_ptr(), t._version, tuple(t.shape), t.dtype, str(t.device))
+
+def kernel_key(kernel):
+    # the kernel hyperparameters (and buffers) are part of the key, an optimizer step or any other
+    # in place update bumps their version counter and with it invalidates the cached matrices.
+    if not isinstance(kernel, torch.nn.Module):
+        return ()
+    return tuple(tensor_key(t) for t in list(kernel.parameters()) + list(kernel.buffers()))
+
+class KernelCache:
+    def __init__(self, max_entries=8):
+        """
+        keyed cache of constant kernel matrices and their factorizations.
+
+        an entry is looked up by the identity of the kernel and of both inputs, and is only valid
+        while the version counters of the inputs and of the kernel hyperparameters are unchanged.
+        the cached matrices are constants: they are computed without autograd, so only use the
+        cache for layers whose inputs and hyperparameters are not trained (e.g. the input layer).
+        """
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _lookup(self, slot, key):
+        entry = self.entries.get(slot)
+        if entry is not None and entry['key'] != key:
+            # same kernel and inputs but they changed in place since.
+            self.invalidations += 1
+            del self.entries[slot]
+            entry = None
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(slot)
+        return entry
+
+    def _insert(self, slot, entry):
+        self.misses += 1
+        self.entries[slot] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+    def rows(self, x, idx):
+        """
+        x[idx] along the point axis, the same tensor is returned as long as x and idx are unchanged
+        so that kernels evaluated against it can be looked up.
+        """
+        slot = ('rows', x.data_ptr(), idx.data_ptr())
+        key = (tensor_key(x), tensor_key(idx))
+        entry = self._lookup(slot, key)
+        if entry is None:
+            entry = self._insert(slot, dict(key=key, refs=(x, idx), value=x.index_select(-2, idx)))
+        return entry['value']
+
+    def cast(self, x, dtype):
+        """
+        x converted to dtype, like `rows` the same tensor is returned as long as x is unchanged.
+        """
+        slot = ('cast', x.data_ptr(), dtype)
+        key = (tensor_key(x),)
+        entry = self._lookup(slot, key)
+        if entry is None:
+            entry = self._insert(slot, dict(key=key, refs=(x,), value=x.detach().to(dtype)))
+        return entry['value']
+
+    def gram(self, x1, x2, kernel, gram_fn):
+        slot = ('gram', id(kernel), x1.data_ptr(), x2.data_ptr())
+        key = (tensor_key(x1), tensor_key(x2), kernel_key(kernel))
+        entry = self._lookup(slot, key)
+        if entry is None:
+            with torch.no_grad():
+                value = gram_fn(x1, x2, kernel)
+            # the references keep the inputs alive so their addresses can not be reused by other tensors.
+            entry = self._insert(slot, dict(key=key, refs=(x1, x2, kernel), value=value, factors={}))
+        return entry['value']
+
+    def extend(self, x1, x2, x1_all, x2_all, kernel, gram_fn):
+        """
+        K(x1_all, x2_all) where x1_all (x2_all) is x1 (x2) followed by new rows. when K(x1, x2) is cached
+        only the blocks of the new rows are evaluated, and the result is cached for the extended inputs.
+        """
+        entry = self._lookup(('gram', id(kernel), x1.data_ptr(), x2.data_ptr()), (tensor_key(x1), tensor_key(x2), kernel_key(kernel)))
+        if entry is None:
+            return self.gram(x1_all, x2_all, kernel, gram_fn)
+
+        n1, n2 = x1.shape[-2], x2.shape[-2]
+        symmetric = x1 is x2 and x1_all is x2_all
+        with torch.no_grad():
+            K = entry['value']
+            if x1_all.shape[-2] > n1:
+                bottom = gram_fn(x1_all[..., n1:, :], x2_all, kernel)
+            if x2_all.shape[-2] > n2:
+                right = bottom[..., :n2].transpose(-1, -2) if symmetric else gram_fn(x1, x2_all[..., n2:, :], kernel)
+                K = torch.cat([K, right], -1)
+            if x1_all.shape[-2] > n1:
+                K = torch.cat([K, bottom], -2)
+
+        slot = ('gram', id(kernel), x1_all.data_ptr(), x2_all.data_ptr())
+        key = (tensor_key(x1_all), tensor_key(x2_all), kernel_key(kernel))
+        self._insert(slot, dict(key=key, refs=(x1_all, x2_all, kernel), value=K, factors={}))
+        return K
+
+    def cholesky(self, x, kernel, gram_fn, ridge=0.0, dtype=None):
+        """
+        cholesky factor of K(x, x) + ridge*I (in `dtype`, default the one of K), cached next to the
+        gram matrix for every ridge value. a factorization that fails is retried with jitter (jittered_cholesky).
+        """
+        K = self.gram(x, x, kernel, gram_fn)
+        factors = self.entries[('gram', id(kernel), x.data_ptr(), x.data_ptr())]['factors']
+        K = K if dtype is None else K.to(dtype)
+        if (ridge, K.dtype) not in factors:
+            factors[ridge, K.dtype] = jittered_cholesky(K + ridge*torch.eye(K.shape[-1], dtype=K.dtype, device=K.device))
+        return factors[ridge, K.dtype]
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, invalidations=self.invalidations, entries=len(self.entries))
+
+    def clear(self):
+        self.entries.clear()
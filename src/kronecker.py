@@ -0,0 +1,128 @@
+"""
+structured grid mode: kernels of tensor product grids as (sums of) kronecker products.
+
+on the grid X = a_1 × ... × a_d (the row order of torch.cartesian_prod, the last axis varies fastest)
+    RBF:        K(X, X) = K_1 ⊗ ... ⊗ K_d                  with K_j = exp(-(a_j - a_jᵀ)² / 2l_j²)
+    polynomial: K(X, X) = (Σ_j a_j a_jᵀ + c)^p = Σ_k C(p, k) (a_1 a_1ᵀ)^k ⊗ (Σ_j>1 a_j a_jᵀ + c)^(p-k)  (recursively)
+so a product K @ W only needs the [n_j, n_j] factors, O(N Σ n_j) instead of O(N²), and a solve
+goes through the eigendecompositions of the factors (single product) or CG (sums).
+"""
+import math
+import torch
+import gpytorch as gpy
+from solvers import conjugate_gradient
+
+def grid_axes(X):
+    """
+    the 1-d axes whose cartesian product are the rows of X, None if X is not such a grid.
+    """
+    if X.dim() != 2:
+        return None
+    axes = [X[:, j].unique() for j in range(X.shape[1])]
+    if math.prod(len(a) for a in axes) != X.shape[0]:
+        return None
+    grid = torch.cartesian_prod(*axes).reshape(X.shape)
+    return axes if torch.equal(grid, X) else None
+
+def _poly_terms(axes, power, offset):
+    first = torch.outer(axes[0], axes[0])
+    if len(axes) == 1:
+        return [(1.0, [(first + offset).pow(power)])]
+    terms = []
+    for k in range(power + 1):
+        for coefficient, factors in _poly_terms(axes[1:], power - k, offset):
+            terms.append((math.comb(power, k)*coefficient, [first.pow(k)] + factors))
+    return terms
+
+def kronecker_terms(kernel, axes):
+    """
+    [(coefficient, [K_1, ..., K_d])] with K(X, X) = Σ coefficient K_1 ⊗ ... ⊗ K_d on the grid of `axes`,
+    None for kernels that do not factor.
+    """
+    if isinstance(kernel, gpy.kernels.ScaleKernel):
+        terms = kronecker_terms(kernel.base_kernel, axes)
+        return None if terms is None else [(kernel.outputscale*c, factors) for c, factors in terms]
+    if isinstance(kernel, gpy.kernels.PolynomialKernel):
+        return _poly_terms(axes, kernel.power, kernel.offset.reshape([]))
+    if isinstance(kernel, gpy.kernels.RBFKernel):
+        lengthscale = kernel.lengthscale.reshape(-1).expand(len(axes))
+        return [(1.0, [torch.exp(-0.5*((a.unsqueeze(1) - a.unsqueeze(0)) / l)**2) for a, l in zip(axes, lengthscale)])]
+    return None
+
+def _kron_apply(factors, V, batch_dims):
+    # (F_1 ⊗ ... ⊗ F_d) applied to V reshaped to [*batch, n_1, ..., n_d, R], one mode at a time.
+    for j, F in enumerate(factors):
+        V = torch.tensordot(F, V, dims=([1], [batch_dims + j])).movedim(0, batch_dims + j)
+    return V
+
+class KroneckerKernel:
+    def __init__(self, terms):
+        """
+        the N x N kernel matrix Σ coefficient K_1 ⊗ ... ⊗ K_d of kronecker_terms, never materialized.
+        """
+        self.terms = terms
+        self.sizes = [F.shape[-1] for F in terms[0][1]]
+        N = math.prod(self.sizes)
+        self.shape = (N, N)
+
+    @classmethod
+    def from_grid(cls, kernel, axes):
+        terms = kronecker_terms(kernel, axes)
+        return None if terms is None else cls(terms)
+
+    def matmul(self, W):
+        """
+        K @ W for W of shape [..., N, R].
+        """
+        batch = W.shape[:-2]
+        V = W.reshape(*batch, *self.sizes, W.shape[-1])
+        out = sum(c*_kron_apply([F.to(W.dtype) for F in factors], V, len(batch)) for c, factors in self.terms)
+        return out.reshape(W.shape)
+
+    def evaluate(self):
+        out = 0
+        for c, factors in self.terms:
+            K = factors[0]
+            for F in factors[1:]:
+                K = torch.kron(K, F)
+            out = out + c*K
+        return out
+
+    def solve(self, Y, ridge=0.0, tol=1e-6, max_iter=None):
+        """
+        (K + ridge I) W = Y for Y of shape [..., N, R].
+
+        a single kronecker product is diagonalized by the eigenvectors of its factors,
+        (Q_1 ⊗ ... ⊗ Q_d)(c Λ_1 ⊗ ... ⊗ Λ_d + ridge)^-1 (Q_1 ⊗ ... ⊗ Q_d)ᵀ Y,
+        sums of kronecker products are solved with CG on the kronecker matmul.
+        """
+        batch = Y.shape[:-2]
+        if len(self.terms) == 1:
+            c, factors = self.terms[0]
+            eigs = [torch.linalg.eigh(F) for F in factors]
+            values = eigs[0].eigenvalues
+            for e in eigs[1:]:
+                values = torch.outer(values, e.eigenvalues).reshape(-1)
+            V = Y.reshape(*batch, *self.sizes, Y.shape[-1])
+            V = _kron_apply([e.eigenvectors.T for e in eigs], V, len(batch)).reshape(Y.shape)
+            V = V / (c*values + ridge).unsqueeze(-1)
+            V = V.reshape(*batch, *self.sizes, Y.shape[-1])
+            return _kron_apply([e.eigenvectors for e in eigs], V, len(batch)).reshape(Y.shape)
+
+        # every column (of every batch entry) is an independent right hand side of the same system.
+        B = Y.movedim(-2, 0).reshape(self.shape[0], -1)
+        matvec = lambda V: self.matmul(V) + ridge*V
+        W = conjugate_gradient(matvec, B, tol=tol, max_iter=max_iter)
+        return W.reshape(Y.shape[-2], *batch, Y.shape[-1]).movedim(0, -2)
+
+def kronecker_fn(kernel, weights, grid_inputs, axes, fallback):
+    """
+    layer function that evaluates K(X, X) @ W through KroneckerKernel when it is called on the
+    grid itself (X = centers = `grid_inputs`) and defers to `fallback` (a fn_init layer) otherwise.
+    """
+    def fn_with_specified_args(inputs, val):
+        if inputs is grid_inputs and val is grid_inputs:
+            return KroneckerKernel.from_grid(kernel, axes).matmul(weights.squeeze(-2))
+        return fallback(inputs, val)
+    fn_with_specified_args.kernel = kernel
+    return fn_with_specified_args
@@ -0,0 +1,169 @@
+"""
+precision policy: the dtype of every stage of a kernel layer.
+
+    kernel:     the kernel matrices are evaluated in this dtype (layer inputs and kernel hyperparameters are cast to it),
+    accumulate: dtype of the weights and of K @ W, i.e. of the layer outputs,
+    solve:      dtype of the linear solves (closed form last layer, KernelRidgeRegression).
+
+a polynomial kernel of degree d raises inner products to the d-th power, its gram matrices overflow and
+become ill conditioned quickly. with a relative rounding error eps of a dtype, products and solves of
+condition number κ lose up to κ·eps relative accuracy, so the policy checks the layer products and the
+solves it sees and prints a warning when κ·eps exceeds `max_error` (or a kernel matrix overflowed).
+"""
+import math
+import torch
+
+DTYPES = dict(bfloat16=torch.bfloat16, float16=torch.float16, float32=torch.float32, float64=torch.float64)
+
+# named policies, (kernel, accumulate, solve) dtypes.
+POLICIES = dict(float32=('float32', 'float32', 'float32'), float64=('float64', 'float64', 'float64'),
+                mixed=('float32', 'float64', 'float64'), bfloat16=('bfloat16', 'float32', 'float64'))
+
+def _name(dtype):
+    return str(dtype).replace('torch.', '')
+
+def as_dtype(dtype):
+    if isinstance(dtype, torch.dtype):
+        return dtype
+    if dtype not in DTYPES:
+        raise ValueError('unknown dtype: ' + str(dtype))
+    return DTYPES[dtype]
+
+def cast(t, dtype, cache=None):
+    """
+    t in `dtype` (None keeps it), constant tensors go through the KernelCache so that the same
+    converted tensor comes back every epoch and kernels evaluated on it are still cache hits.
+    """
+    if dtype is None or t.dtype == dtype:
+        return t
+    if cache is not None and not t.requires_grad:
+        return cache.cast(t, dtype)
+    return t.to(dtype)
+
+def condition_number(K, ridge=0.0, max_size=1024):
+    """
+    2-norm condition number of K (+ ridge*I for a square K) in float64, of the first model of a batch.
+    above `max_size` an evenly spaced subset of the rows (and the same columns of a square K) is used,
+    which underestimates it.
+    """
+    with torch.no_grad():
+        K = K.detach().to(torch.float64)
+        while K.dim() > 2:
+            K = K[0]
+        square = K.shape[-2] == K.shape[-1]
+        if K.shape[-2] > max_size:
+            rows = torch.linspace(0, K.shape[-2] - 1, max_size, device=K.device).long()
+            K = K[rows][:, rows] if square else K[rows]
+        s = torch.linalg.svdvals(K)
+        if square:
+            s = s + ridge
+        return (s[0] / s[-1].clamp(min=1e-300)).item()
+
+class PrecisionPolicy:
+    def __init__(self, kernel='float32', accumulate='float64', solve='float64', check_conditioning=True, max_error=1e-2, check_every=100):
+        """
+        dtypes of the kernel evaluation, the accumulation K @ W and the linear solves ('bfloat16',
+        'float16', 'float32', 'float64' or torch dtypes). the default evaluates the kernels in float32
+        and accumulates and solves in float64.
+        check_conditioning: check the layer products K @ W and the solves and print a warning (once per
+                            layer and system) when they are too ill conditioned for the dtypes.
+        max_error: tolerated κ·eps before warning.
+        check_every: calls of a layer between the host reads of its product condition (see check_kernel).
+        """
+        self.kernel = as_dtype(kernel)
+        self.accumulate = as_dtype(accumulate)
+        self.solve = as_dtype(solve)
+        self.check_conditioning = check_conditioning
+        self.max_error = max_error
+        self.check_every = check_every
+        self._checked = set()
+        self._warned = set()
+        self._pending = {}
+
+    @classmethod
+    def from_name(cls, name, **kwargs):
+        if name not in POLICIES:
+            raise ValueError('unknown precision policy: ' + str(name) + ', expected one of ' + str(list(POLICIES)))
+        return cls(*POLICIES[name], **kwargs)
+
+    def kernel_inputs(self, X, Y, cache=None):
+        """
+        both kernel arguments in the kernel dtype, K(X, X) stays symmetric (the same tensor twice).
+        """
+        X_ = cast(X, self.kernel, cache)
+        return X_, X_ if Y is X else cast(Y, self.kernel, cache)
+
+    def _warn(self, key, message):
+        # every matrix (key) warns once.
+        if key is not None and key in self._warned:
+            return
+        if key is not None:
+            self._warned.add(key)
+        print('precision warning:', message)
+
+    def check_kernel(self, K, W, out, key=None):
+        """
+        warn if the product out = K @ W loses more than max_error relative accuracy to the rounding of K
+        in the kernel dtype: overflowed entries, or a product condition ||K|| ||W|| / ||K W|| too large
+        (cancellation, e.g. weights that grew along the near null space of a polynomial kernel).
+
+        the condition stays on the device, the worst one of every `key` (layer) is only read by the host
+        at its first call and then every `check_every` calls, so training does not sync every epoch.
+        a layer that warned is not checked anymore. returns the condition when it was read, else None.
+        """
+        if not self.check_conditioning or (key is not None and key in self._warned):
+            return None
+        with torch.no_grad():
+            norm = lambda t: t.float().norm() if torch.finfo(t.dtype).bits < 32 else t.norm()
+            # inf or nan when K overflowed, torch.maximum keeps the nan.
+            cond = norm(K)*norm(W) / norm(out).clamp(min=1e-30)
+            calls, worst = self._pending.get(key, (0, None))
+            worst = cond if worst is None else torch.maximum(worst, cond)
+            if key is not None and calls % self.check_every != 0:
+                self._pending[key] = (calls + 1, worst)
+                return None
+            self._pending[key] = (calls + 1, None)
+            cond = worst.item()
+
+        if not math.isfinite(cond):
+            self._warn(key, 'a kernel matrix ' + str(tuple(K.shape)) + ' has non finite entries in ' + _name(self.kernel)
+                       + ' (overflow), use a wider kernel dtype or a smaller polynomial degree')
+            return float('inf')
+        error = cond*torch.finfo(self.kernel).eps
+        if error > self.max_error:
+            self._warn(key, f'K @ W with a kernel matrix {tuple(K.shape)} has condition number {cond:.3g}, relative errors up to '
+                            f'{error:.2g} in {_name(self.kernel)}, use a wider kernel dtype')
+        return cond
+
+    def check_solve(self, A, ridge=0.0, key=None):
+        """
+        warn if the system matrix A (+ ridge*I) is too ill conditioned for the solve, the rounding of its
+        kernel entries counts as well as the one of the solve dtype. with a `key` a system is only checked
+        the first time (it costs an SVD). returns the condition number.
+        """
+        if not self.check_conditioning or (key is not None and key in self._checked):
+            return None
+        if key is not None:
+            self._checked.add(key)
+        if not torch.isfinite(A).all():
+            self._warn(key, 'a system matrix ' + str(tuple(A.shape)) + ' has non finite entries, use a wider kernel dtype')
+            return float('inf')
+
+        cond = condition_number(A, ridge)
+        dtype = max(self.kernel, self.solve, key=lambda d: torch.finfo(d).eps)
+        error = cond*torch.finfo(dtype).eps
+        if error > self.max_error:
+            self._warn(key, f'a system matrix {tuple(A.shape)} has condition number {cond:.3g}, relative errors up to '
+                            f'{error:.2g} in {_name(dtype)}, use a wider dtype or a larger ridge')
+        return cond
+
+    def __repr__(self):
+        return 'PrecisionPolicy(kernel=' + _name(self.kernel) + ', accumulate=' + _name(self.accumulate) + ', solve=' + _name(self.solve) + ')'
+
+def resolve(precision):
+    """
+    a PrecisionPolicy from a policy, a name of POLICIES or None (no policy, everything in the input dtypes).
+    """
+    if precision is None or isinstance(precision, PrecisionPolicy):
+        return precision
+    return PrecisionPolicy.from_name(precision)
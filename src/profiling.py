@@ -0,0 +1,110 @@
+import contextlib
+import time
+import torch
+from rff import RandomFourierFeatures
+
+class LayerProfiler:
+    def __init__(self, trace_path=None):
+        """
+        opt-in per layer instrumentation of realize_composite_fns.
+
+        for every layer it aggregates the forward and backward wall time, an estimate of the flops,
+        the peak tensor memory (measured on cuda, estimated from the kernel/output sizes on cpu) and
+        the kernel matrix shape and dtype. with `trace_path` set, `trace()` exports a torch.profiler
+        chrome trace where every layer is a labeled range.
+        """
+        self.trace_path = trace_path
+        self.layers = {}
+        self._events = []
+        self._tracing = False
+
+    def _record(self, i):
+        if i not in self.layers:
+            self.layers[i] = dict(calls=0, forward_s=0.0, backward_s=0.0, backward_calls=0, flops=0,
+                                  peak_bytes=0, kernel_shape=None, dtype=None)
+        return self.layers[i]
+
+    def run_layer(self, i, fn, prev_val, centers):
+        record = self._record(i)
+        kernel = getattr(fn, 'kernel', None)
+        N1, D = prev_val.shape[-2], prev_val.shape[-1]
+        N2 = kernel.num_features if isinstance(kernel, RandomFourierFeatures) else centers.shape[-2]
+        cuda = prev_val.is_cuda
+        if cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            mem_before = torch.cuda.memory_allocated()
+
+        start = time.perf_counter()
+        if self._tracing:
+            with torch.profiler.record_function('layer_' + str(i)):
+                out = fn(prev_val, centers)
+        else:
+            out = fn(prev_val, centers)
+        if cuda:
+            torch.cuda.synchronize()
+        record['forward_s'] += time.perf_counter() - start
+
+        R = out.shape[-1]
+        batch = out.numel() // (N1*R)
+        if cuda:
+            peak = torch.cuda.max_memory_allocated() - mem_before
+        else:
+            peak = batch*(N1*N2 + N1*R)*out.element_size()
+        record['calls'] += 1
+        # kernel evaluation (~3 flops per input dimension and pair) + the kernel-weights product.
+        record['flops'] += batch*(3*N1*N2*D + 2*N1*N2*R)
+        record['peak_bytes'] = max(record['peak_bytes'], peak)
+        record['kernel_shape'] = [N1, N2] if batch == 1 else [batch, N1, N2]
+        record['dtype'] = str(out.dtype)
+
+        if out.requires_grad:
+            out.register_hook(self._stamp(i, 'out'))
+            if prev_val.requires_grad:
+                prev_val.register_hook(self._stamp(i, 'in'))
+        return out
+
+    def _stamp(self, i, kind):
+        def _hook(grad):
+            self._events.append((time.perf_counter(), i, kind))
+        return _hook
+
+    def end_backward(self):
+        """
+        call after loss.backward() to attribute the backward time to the layers, a layer runs from the
+        arrival of the gradient at its output to the gradient at its input (or the end of the backward pass).
+        """
+        end = time.perf_counter()
+        starts = {i: t for t, i, kind in self._events if kind == 'out'}
+        ends = {i: t for t, i, kind in self._events if kind == 'in'}
+        for i, t in starts.items():
+            record = self._record(i)
+            record['backward_s'] += ends.get(i, end) - t
+            record['backward_calls'] += 1
+        self._events = []
+
+    @contextlib.contextmanager
+    def trace(self, path=None):
+        path = path or self.trace_path
+        self._tracing = True
+        try:
+            with torch.profiler.profile(record_shapes=True, profile_memory=True) as prof:
+                yield prof
+        finally:
+            self._tracing = False
+        prof.export_chrome_trace(path)
+        print('trace written to ', path)
+
+    def summary(self):
+        lines = ['layer  calls  forward_ms  backward_ms  GFLOP/call  peak_MiB  kernel  dtype']
+        for i in sorted(self.layers):
+            r = self.layers[i]
+            calls = max(r['calls'], 1)
+            lines.append(f"{i:>5}  {r['calls']:>5}  {1e3*r['forward_s']/calls:>10.3f}  "
+                         f"{1e3*r['backward_s']/max(r['backward_calls'], 1):>11.3f}  {r['flops']/calls/1e9:>10.4f}  "
+                         f"{r['peak_bytes']/2**20:>8.2f}  {r['kernel_shape']}  {r['dtype']}")
+        return '\n'.join(lines)
+
+    def reset(self):
+        self.layers = {}
+        self._events = []
@@ -1,13 +1,23 @@
 import torch
-from utils import e2eKRR, e2eSKRR, createSyntheticData
+from utils import e2eKRR, e2eSKRR, directKRR, createSyntheticData
+from experiments import run_experiments, fig3_configs, model_from_result
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
-def repr_fig3(num_data_points=5,num_epochs=10000, viz_prediction_only=False):
+def repr_fig3(num_data_points=5,num_epochs=10000, viz_prediction_only=False, num_landmarks=None, num_features=None, num_workers=None, result_path=None, batch_targets=False, iterative_baseline=False):
     """
     Reproducing the result shown in figure3
 
     Visualizing the loss or only predictions from 2 deep kernel architectures.
+
+    for large grids set num_landmarks (inner layer) and num_features (outer layer)
+    so that the deep models cost is linear in the number of points.
+
+    num_workers: train the six models in parallel on a cpu process pool (see experiments.run_experiments),
+                 result_path: where to store the trained weights and losses of that run.
+    batch_targets: fit h1 and h2 together in one batched model per degree (they share the input kernel).
+    iterative_baseline: train the single layer baseline as a gaussian process (e2eSKRR) instead of
+                        solving it in closed form (directKRR).
     """
 
     # check for cuda
@@ -29,16 +39,41 @@ def repr_fig3(num_data_points=5,num_epochs=10000, viz_prediction_only=False):
 
 
     # calculating the models for constructing h1 and h2 functions.
-    first_layer_poly_kernel_degree = 1
-    model_comp_h1_v1 = e2eKRR(data_x, data_y_h1, ranges, first_layer_poly_kernel_degree, device, num_epochs)
-    model_comp_h2_v1 = e2eKRR(data_x, data_y_h2*1.0, ranges, first_layer_poly_kernel_degree, device, num_epochs)
-
-    first_layer_poly_kernel_degree = 2
-    model_comp_h1_v2 = e2eKRR(data_x, data_y_h1, ranges, first_layer_poly_kernel_degree, device, num_epochs)
-    model_comp_h2_v2 = e2eKRR(data_x, data_y_h2, ranges, first_layer_poly_kernel_degree, device, num_epochs)
-
-    model_single_h1 = e2eSKRR(data_x, data_y_h1, device, num_epochs)
-    model_single_h2 = e2eSKRR(data_x, data_y_h2, device, num_epochs)
+    scale_args = dict(num_landmarks=num_landmarks, num_features=num_features)
+    if num_workers is not None:
+        configs = [c for c in fig3_configs(num_data_points, num_epochs, **scale_args) if iterative_baseline or c['model'] == 'e2eKRR']
+        results = run_experiments(configs, num_workers, result_path=result_path)
+        models = {name: model_from_result(result, device) for name, result in results.items()}
+        model_comp_h1_v1, model_comp_h2_v1 = models['e2eKRR_h1_p1_s0'], models['e2eKRR_h2_p1_s0']
+        model_comp_h1_v2, model_comp_h2_v2 = models['e2eKRR_h1_p2_s0'], models['e2eKRR_h2_p2_s0']
+        if iterative_baseline:
+            model_single_h1, model_single_h2 = models['e2eSKRR_h1_s0'], models['e2eSKRR_h2_s0']
+    elif batch_targets:
+        data_y_h12 = torch.stack([data_y_h1, data_y_h2*1.0])
+        model_comp_v1 = e2eKRR(data_x, data_y_h12, ranges, 1, device, num_epochs, **scale_args)
+        model_comp_v2 = e2eKRR(data_x, data_y_h12, ranges, 2, device, num_epochs, **scale_args)
+        model_comp_h1_v1, model_comp_h2_v1 = (lambda X: model_comp_v1(X)[0]), (lambda X: model_comp_v1(X)[1])
+        model_comp_h1_v2, model_comp_h2_v2 = (lambda X: model_comp_v2(X)[0]), (lambda X: model_comp_v2(X)[1])
+
+        if iterative_baseline:
+            model_single_h1 = e2eSKRR(data_x, data_y_h1, device, num_epochs)
+            model_single_h2 = e2eSKRR(data_x, data_y_h2, device, num_epochs)
+    else:
+        first_layer_poly_kernel_degree = 1
+        model_comp_h1_v1 = e2eKRR(data_x, data_y_h1, ranges, first_layer_poly_kernel_degree, device, num_epochs, **scale_args)
+        model_comp_h2_v1 = e2eKRR(data_x, data_y_h2*1.0, ranges, first_layer_poly_kernel_degree, device, num_epochs, **scale_args)
+
+        first_layer_poly_kernel_degree = 2
+        model_comp_h1_v2 = e2eKRR(data_x, data_y_h1, ranges, first_layer_poly_kernel_degree, device, num_epochs, **scale_args)
+        model_comp_h2_v2 = e2eKRR(data_x, data_y_h2, ranges, first_layer_poly_kernel_degree, device, num_epochs, **scale_args)
+
+        if iterative_baseline:
+            model_single_h1 = e2eSKRR(data_x, data_y_h1, device, num_epochs)
+            model_single_h2 = e2eSKRR(data_x, data_y_h2, device, num_epochs)
+
+    if not iterative_baseline:
+        model_single_h1 = directKRR(data_x, data_y_h1, device)
+        model_single_h2 = directKRR(data_x, data_y_h2, device)
 
     # Calculate the predictions.
     pred_y_comp_h1_v1 = model_comp_h1_v1(data_x)
@@ -46,8 +81,9 @@ def repr_fig3(num_data_points=5,num_epochs=10000, viz_prediction_only=False):
     pred_y_comp_h1_v2 = model_comp_h1_v2(data_x)
     pred_y_comp_h2_v2 = model_comp_h2_v2(data_x)
 
-    pred_y_single_h1 = model_single_h1(data_x).mean
-    pred_y_single_h2 = model_single_h2(data_x).mean
+    # the gaussian process baseline predicts its posterior mean [N], the closed form one [N, 1].
+    pred_y_single_h1 = model_single_h1(data_x).mean if iterative_baseline else model_single_h1(data_x).squeeze(1)
+    pred_y_single_h2 = model_single_h2(data_x).mean if iterative_baseline else model_single_h2(data_x).squeeze(1)
 
     # calculating the loss at each point.
     loss_comp_h1_v1 = torch.abs(pred_y_comp_h1_v1 - data_y_h1*viz_prediction_only)
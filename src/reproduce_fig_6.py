@@ -2,9 +2,9 @@ import torch
 import torch.nn as nn
 import numpy as np
 from PIL import Image
-from wand.image import Image, Color
-from itertools import chain
-from utils import e2eKRR, createSyntheticData, remap, griddify, shape_to_rect, grid_to_mesh
+from utils import e2eKRR, createSyntheticData, log_callback, remap, griddify, shape_to_rect, grid_to_mesh
+from warp import roll_columns, warp_layer
+from snapshots import snapshot_callback, export_frames
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import matplotlib.pyplot as plt
@@ -76,7 +76,11 @@ def repr_fig6_plotly(num_data_points=10, num_epochs=2000):
     fig.show()
 
 
-def repr_fig6_exp(num_data_points=10, num_epochs=10000):
+def repr_fig6_exp(num_data_points=10, num_epochs=10000, resolution=512, snapshot_path=None, snapshot_every=100, frames_dir=None):
+    """
+    snapshot_path: stream the first layer output to this file every `snapshot_every` epochs (see snapshots.py),
+    frames_dir: render those snapshots there (in parallel, headless) as frames and an animation.
+    """
     # check for cuda
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     #device = 'cpu'
@@ -89,67 +93,38 @@ def repr_fig6_exp(num_data_points=10, num_epochs=10000):
 
     # calculating the models for constructing h1 and h2 functions.
     first_layer_poly_kernel_degree = 2
-    model_comp_h1_v1 = e2eKRR(data_x, data_y_h1, ranges, first_layer_poly_kernel_degree, device, num_epochs, retain_layer_outputs=True)
+    callbacks = [log_callback(1000)]
+    if snapshot_path is not None:
+        callbacks.append(snapshot_callback(snapshot_path, snapshot_every, layers=(0,)))
+    model_comp_h1_v1 = e2eKRR(data_x, data_y_h1, ranges, first_layer_poly_kernel_degree, device, num_epochs, retain_layer_outputs=True, callbacks=callbacks)
     layer_outputs = model_comp_h1_v1.layer_outputs
 
     l0_out = layer_outputs[0].detach() # layer 0 outputs
     l0_out = l0_out.cpu().detach().numpy()
 
+    if snapshot_path is not None and frames_dir is not None:
+        export_frames(snapshot_path, frames_dir, 0, data_y_h1.reshape(num_data_points, num_data_points), animation='layer_0.gif')
+
     # convert data_y into rgb image data
-    data_y_h1 = data_y_h1.squeeze(1)
-    data_y_h2 = data_y_h2.squeeze(1)
+    data_y_h1 = data_y_h1.squeeze(1).cpu().numpy()
     data_y_h1_grid = np.reshape(data_y_h1, [num_data_points, num_data_points, 1])
     data_y_rgb = np.concatenate([data_y_h1_grid, data_y_h1_grid, data_y_h1_grid], 2)
+    data_y_rgb = remap(data_y_rgb, np.min(data_y_rgb), np.max(data_y_rgb), 0.0, 1.0)
 
-    # convert array into image
-    img = Image.from_array(data_y_rgb)
-
-    # image utils for easier viewing.
-    img.background_color = Color('skyblue')
-    img.virtual_pixel = 'background'
-    dist_img = img.clone()
-    print('l0: ', l0_out, torch.min(data_x), torch.max(data_x))
-
-
-    bins = num_data_points
-    # NOTE: here, first index = column and second index traverse rows
-
-    # source and dest points for experiment
-    source_points = (
-        (0, 0),
-        (0, bins),
-        (bins, 0),
-        (bins, bins)
-    )
-    destination_points = (
-        (0,0),
-        (0 ,bins+2),
-        (bins, 0),
-        (bins, bins)
-    )
-
-    # source points = input data.
+    # source points = input data (the grid nodes).
     # destination points = input data after rkhs layer to see how this layer morph the input data.
-    data_x = data_x.cpu().detach().numpy()
-    data_x_new = remap(data_x, np.min(data_x), np.max(data_x), 0, num_data_points)
-    l0_out = remap(l0_out, np.min(l0_out), np.max(l0_out), np.min(l0_out)*(num_data_points/2), np.max(l0_out)*(num_data_points/2)) + num_data_points/2
-    source_points = data_x_new
-    destination_points = l0_out
-
-    print('data_x_new', data_x, np.min(l0_out), np.max(l0_out))
-
-    # gives the effect of zoom and pan.
-    dist_img.artifacts['distort:viewport'] = '500x500-250-250'
+    dist_img, bounds = warp_layer(data_y_rgb, l0_out, resolution)
+    print('l0 bounds: ', bounds)
 
-    # prepare the args and distorting.
-    order = chain.from_iterable(zip(source_points, destination_points))
-    dist_args = list(chain.from_iterable(order))
-    dist_img.distort('bilinear_forward', dist_args)
+    # uncovered pixels (nan) are drawn as the background.
+    background = np.array([135, 206, 235]) / 255 # skyblue
+    dist_img = np.where(np.isnan(dist_img), background, dist_img)
+    (lo0, hi0), (lo1, hi1) = bounds
 
     #plotting...
     fig, axs = plt.subplots(2,2)
     axs[0,0].imshow(data_y_rgb)
-    axs[0,1].imshow(dist_img)
+    axs[0,1].imshow(dist_img, extent=(lo1, hi1, hi0, lo0))
     plt.show()
 
 
@@ -209,8 +184,7 @@ def repr_fig6(num_data_points=10, num_epochs=10000):
 
     print(img[:,0], img.shape)
 
-    for i in range(img.shape[0]):
-        img[:,i] = np.roll(img[:,i], int(shift(i)))
+    img = roll_columns(img, [int(shift(i)) for i in range(img.shape[1])])
 
     axs[0,0].imshow(data_y_h1)
     axs[0,1].imshow(data_y_h2)
@@ -0,0 +1,51 @@
+import math
+import torch
+import torch.nn as nn
+
+class RandomFourierFeatures(nn.Module):
+    def __init__(self, input_dim, num_features=1024, nu=2.5, lengthscale=1.0, seed=None):
+        """
+        random fourier feature map phi(x) with phi(x1) @ phi(x2).T ≈ k(x1, x2) for a stationary kernel.
+
+        the frequencies are sampled from the spectral density of the kernel,
+        a gaussian for the RBF kernel (nu=None) and a student-t with 2*nu degrees of freedom for Matern(nu).
+        a layer with this kernel is evaluated in feature space i.e, phi(X) @ W with W of shape [num_features, 1, R].
+        """
+        super(RandomFourierFeatures, self).__init__()
+        self.input_dim = input_dim
+        self.num_features = num_features
+        self.nu = nu
+        self.lengthscale = lengthscale
+
+        generator = torch.Generator()
+        if seed is not None:
+            generator.manual_seed(seed)
+
+        omega = torch.randn([input_dim, num_features], generator=generator)
+        if nu is not None:
+            # z * sqrt(2nu / chi2(2nu)) is student-t distributed, chi2(2nu) = 2*Gamma(nu, 1).
+            gamma = torch._standard_gamma(torch.full([num_features], float(nu)), generator=generator)
+            omega = omega * torch.sqrt(nu / gamma)
+        omega = omega / lengthscale
+        bias = torch.rand([num_features], generator=generator) * 2 * math.pi
+
+        self.register_buffer('omega', omega)
+        self.register_buffer('bias', bias)
+
+    @classmethod
+    def from_kernel(cls, kernel, input_dim, num_features=1024, seed=None):
+        """
+        feature map approximating a gpytorch MaternKernel or RBFKernel with its current lengthscale.
+        """
+        nu = getattr(kernel, 'nu', None)
+        lengthscale = kernel.lengthscale.detach().reshape(-1)[0].item()
+        return cls(input_dim, num_features, nu=nu, lengthscale=lengthscale, seed=seed)
+
+    def features(self, x):
+        return math.sqrt(2.0 / self.num_features) * torch.cos(x.matmul(self.omega) + self.bias)
+
+    def forward(self, x1, x2=None):
+        # approximate kernel matrix, lets the feature map stand in wherever a dense kernel is expected.
+        phi_1 = self.features(x1)
+        phi_2 = phi_1 if x2 is None else self.features(x2)
+        return phi_1.matmul(phi_2.transpose(-1, -2))
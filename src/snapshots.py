@@ -0,0 +1,142 @@
+"""
+streaming training snapshots and headless frame export.
+
+a snapshot file is append only: the magic bytes, the length of a JSON header (uint32), the header and
+then one fixed size record per snapshot (epoch, loss and the selected layer outputs as float32).
+the header holds the numpy dtype of a record, so the frames can be memory mapped without ever
+holding them all in memory.
+"""
+import json
+import os
+import multiprocessing as mp
+import numpy as np
+import torch
+
+MAGIC = b'DKRSNAP1'
+
+def _record_dtype(layers, shapes):
+    return np.dtype([('epoch', '<i8'), ('loss', '<f4')] + [('layer_' + str(i), '<f4', shape) for i, shape in zip(layers, shapes)])
+
+def snapshot_callback(path, every=100, layers=(0,), model=None):
+    """
+    train_loop callback that appends the outputs of `layers` to the snapshot file `path` every `every` epochs.
+
+    the layer outputs are the ones of the last forward pass, so the model has to be created with
+    retain_layer_outputs=True (also with solve_last_layer, train_loop then sees a VariableProjection that
+    exposes the layer outputs of its model). pass `model` for any other stand-in that does not.
+    an existing file at `path` is replaced by the first snapshot.
+    """
+    state = dict(dtype=None)
+    def _fn(epoch, loss, train_model):
+        if epoch % every != 0:
+            return
+        outputs = (model or train_model).layer_outputs
+        if len(outputs) == 0:
+            raise ValueError('no layer outputs to snapshot, create the model with retain_layer_outputs=True')
+        arrays = [outputs[i].detach().cpu().numpy() for i in layers]
+
+        if state['dtype'] is None:
+            state['dtype'] = _record_dtype(layers, [a.shape for a in arrays])
+            header = json.dumps(dict(layers=list(layers), every=every, dtype=state['dtype'].descr)).encode()
+            with open(path, 'wb') as f:
+                f.write(MAGIC + np.uint32(len(header)).tobytes() + header)
+
+        record = np.zeros((), dtype=state['dtype'])
+        record['epoch'] = epoch
+        record['loss'] = loss.item()
+        for i, a in zip(layers, arrays):
+            record['layer_' + str(i)] = a
+        with open(path, 'ab') as f:
+            f.write(record.tobytes())
+    return _fn
+
+def load_snapshots(path):
+    """
+    header dict and a read only memory mapped record array of a snapshot file.
+    a partially written last record (interrupted run) is ignored.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a snapshot file')
+        header_size = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+        header = json.loads(f.read(header_size))
+    dtype = np.dtype([tuple(field) if len(field) == 2 else (field[0], field[1], tuple(field[2])) for field in header['dtype']])
+    offset = len(MAGIC) + 4 + header_size
+    num_records = (os.path.getsize(path) - offset) // dtype.itemsize
+    if num_records == 0:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(num_records,))
+
+def render_frame(task):
+    """
+    draw one snapshot into an image file. 2-d layer outputs of a square grid with grid `values`
+    are rendered as a mesh warp (warp.warp_layer), anything else as a scatter of its first two coordinates.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from warp import warp_layer
+
+    _, records = load_snapshots(task['snapshot_path'])
+    record = records[task['index']]
+    out = np.asarray(record[task['field']]).reshape(-1, record[task['field']].shape[-1])
+    values = task['values']
+    (lo0, hi0), (lo1, hi1) = task['bounds']
+
+    fig, ax = plt.subplots(figsize=(task['size'], task['size']))
+    if values is not None and values.ndim == 2 and out.shape[1] == 2 and values.size == len(out):
+        img, _ = warp_layer(values, out, task['resolution'], bounds=task['bounds'])
+        ax.imshow(img, extent=(lo1, hi1, hi0, lo0))
+    else:
+        colors = np.arange(len(out)) if values is None else values.reshape(-1)
+        ax.scatter(out[:, 1 % out.shape[1]], out[:, 0], c=colors, s=4)
+        ax.set_xlim(lo1, hi1)
+        ax.set_ylim(hi0, lo0)
+    ax.set_title('epoch ' + str(int(record['epoch'])) + '  loss ' + format(float(record['loss']), '.4g'))
+    fig.savefig(task['out_path'])
+    plt.close(fig)
+    return task['out_path']
+
+def export_frames(snapshot_path, out_dir, layer=0, values=None, num_workers=None, image_format='png',
+                  resolution=256, size=5, animation=None, duration=100):
+    """
+    render every snapshot of `layer` to out_dir/frame_00000.png, ... on a pool of headless worker processes.
+
+    values: optional [n, n] image of the input grid (e.g. the targets) warped by the layer.
+    animation: optional file name (e.g. 'evolution.gif') in out_dir to assemble the frames into.
+    the axis limits are the same for all frames so the animation does not jump.
+    returns the paths of the frames.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    header, records = load_snapshots(snapshot_path)
+    field = 'layer_' + str(layer)
+    # shared axis limits of all frames, one record at a time.
+    D = records[field].shape[-1]
+    axes = [0, 1 % D]
+    lo, hi = np.full(2, np.inf), np.full(2, -np.inf)
+    for record in records:
+        out = record[field].reshape(-1, D)[:, axes]
+        lo, hi = np.minimum(lo, out.min(0)), np.maximum(hi, out.max(0))
+    bounds = ((float(lo[0]), float(hi[0])), (float(lo[1]), float(hi[1])))
+    num_frames = len(records)
+    if isinstance(values, torch.Tensor):
+        values = values.detach().cpu().numpy()
+    del records
+
+    tasks = [dict(snapshot_path=snapshot_path, index=i, field=field, values=values, bounds=bounds, resolution=resolution,
+                  size=size, out_path=os.path.join(out_dir, 'frame_' + str(i).zfill(5) + '.' + image_format))
+             for i in range(num_frames)]
+
+    if num_workers is None:
+        num_workers = mp.cpu_count()
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(num_workers) as pool:
+        paths = pool.map(render_frame, tasks, chunksize=1)
+    print('exported ', len(paths), ' frames to ', out_dir)
+
+    if animation is not None and len(paths) > 0:
+        from PIL import Image
+        frames = [Image.open(p) for p in paths]
+        frames[0].save(os.path.join(out_dir, animation), save_all=True, append_images=frames[1:], duration=duration, loop=0)
+        print('animation written to ', os.path.join(out_dir, animation))
+    return paths
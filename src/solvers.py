@@ -0,0 +1,112 @@
+import torch
+
+def jittered_cholesky(A, jitter=0.0, max_tries=4):
+    """
+    cholesky factor of a symmetric positive (semi-)definite A.
+    if the factorization fails the diagonal jitter is increased tenfold (starting at 1e-6 * mean diagonal).
+    """
+    eye = torch.eye(A.shape[-1], dtype=A.dtype, device=A.device)
+    base_jitter = 1e-6 * A.diagonal(dim1=-2, dim2=-1).abs().mean().clamp(min=1e-12)
+    for i in range(max_tries + 1):
+        L, info = torch.linalg.cholesky_ex(A + jitter*eye)
+        if not info.any():
+            return L
+        jitter = base_jitter * 10**i
+    raise RuntimeError('cholesky failed, matrix is not positive definite even with jitter ' + str(jitter))
+
+def cholesky_solve(A, B, jitter=0.0, max_tries=4):
+    """
+    solve A X = B for a symmetric positive (semi-)definite A through its (jittered_cholesky) factor.
+    """
+    return torch.cholesky_solve(B, jittered_cholesky(A, jitter, max_tries))
+
+def conjugate_gradient(matvec, B, X0=None, tol=1e-6, max_iter=None, precond=None):
+    """
+    solve A X = B (column wise) with the (preconditioned) conjugate gradient method.
+
+    matvec: fn returning A @ X for an [N, C] block.
+    precond: optional fn returning P^-1 @ R for an [N, C] block.
+    raises a RuntimeError when the iteration breaks down (non finite residual or non positive curvature)
+    instead of iterating on garbage.
+    """
+    if max_iter is None:
+        max_iter = B.shape[0]
+    if precond is None:
+        precond = lambda R: R
+
+    X = torch.zeros_like(B) if X0 is None else X0.clone()
+    R = B - matvec(X)
+    Z = precond(R)
+    P = Z
+    rz = (R*Z).sum(0)
+    b_norm = B.norm(dim=0).clamp(min=1e-30)
+
+    for i in range(max_iter):
+        residual = (R.norm(dim=0) / b_norm).max()
+        if not torch.isfinite(residual):
+            raise RuntimeError('conjugate gradient diverged, non finite residual after ' + str(i) + ' iterations')
+        if residual < tol:
+            break
+        AP = matvec(P)
+        pAp = (P*AP).sum(0)
+        if (pAp <= 0).any() or (rz < 0).any():
+            # A (or the preconditioner) is not positive definite at the precision of B, e.g. a ridge
+            # below the rounding error of the kernel entries.
+            raise RuntimeError('conjugate gradient breakdown after ' + str(i) + ' iterations, the matrix is not positive definite in '
+                               + str(B.dtype) + ', use a wider dtype or a larger ridge')
+        alpha = rz / pAp
+        X = X + alpha*P
+        R = R - alpha*AP
+        Z = precond(R)
+        rz_new = (R*Z).sum(0)
+        P = Z + (rz_new / rz.clamp(min=1e-30))*P
+        rz = rz_new
+
+    return X
+
+def solve_spd(A, B, solver='cholesky', X0=None, tol=1e-6, max_iter=None):
+    """
+    solve A X = B for a symmetric positive definite A, solver is either 'cholesky' or 'cg'.
+    """
+    if solver == 'cholesky':
+        return cholesky_solve(A, B)
+    if solver == 'cg':
+        return conjugate_gradient(A.matmul, B, X0, tol, max_iter)
+    raise ValueError('unknown solver: ' + str(solver))
+
+def pivoted_cholesky(diag, row, rank, tol=1e-10):
+    """
+    low rank factor L [N, k] with L Lᵀ ≈ A from only k rows of A, the pivot is always the largest
+    remaining diagonal entry. stops early once the trace of the residual falls below tol * trace(A),
+    or once the pivot is at the rounding level of the dtype (eps * N * max(diag)): the residual of a
+    low rank A (e.g. a polynomial kernel) is then only rounding error, and dividing by its square root
+    would blow up the factor.
+
+    diag: the diagonal of A, row: fn returning row i of A.
+    """
+    N = diag.shape[-1]
+    rank = min(rank, N)
+    d = diag.clone()
+    L = diag.new_zeros([N, rank])
+    threshold = tol * diag.sum()
+    pivot_threshold = torch.finfo(diag.dtype).eps * N * diag.max()
+    for k in range(rank):
+        if d.sum() <= threshold:
+            return L[:, :k]
+        i = int(d.argmax())
+        if d[i] <= pivot_threshold:
+            return L[:, :k]
+        l = (row(i) - L[:, :k].matmul(L[i, :k])) / d[i].sqrt()
+        L[:, k] = l
+        d = (d - l**2).clamp(min=0)
+    return L
+
+def low_rank_precond(L, ridge):
+    """
+    P^-1 R for P = L Lᵀ + ridge I through the woodbury identity, O(N k) per application.
+    """
+    eye = torch.eye(L.shape[-1], dtype=L.dtype, device=L.device)
+    C = torch.linalg.cholesky(ridge*eye + L.T.matmul(L))
+    def precond(R):
+        return (R - L.matmul(torch.cholesky_solve(L.T.matmul(R), C))) / ridge
+    return precond
@@ -1,15 +1,12 @@
-from numpy.core.numeric import ones
-from compositeKRR import SingleLayerKRR, DeepKernelRegression
-import math
+from compositeKRR import SingleLayerKRR, DeepKernelRegression, KernelRidgeRegression, VariableProjection
+from rff import RandomFourierFeatures
+from inference import export_artifact
+import time
+import contextlib
 import torch
 import torch.nn as nn
-import torchviz
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
 import gpytorch as gpy
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.transforms as mtransforms
 
 def remap( x, oMin, oMax, nMin, nMax ):
 	
@@ -69,18 +66,11 @@ def shape_to_rect(shape):
 def griddify(rect, w_div, h_div):
     w = rect[2] - rect[0]
     h = rect[3] - rect[1]
-    x_step = w / float(w_div)
-    y_step = h / float(h_div)
-    y = rect[1]
-    grid_vertex_matrix = []
-    for _ in range(h_div + 1):
-        grid_vertex_matrix.append([])
-        x = rect[0]
-        for _ in range(w_div + 1):
-            grid_vertex_matrix[-1].append([int(x), int(y)])
-            x += x_step
-        y += y_step
-    grid = np.array(grid_vertex_matrix)
+    # running sums, the same vertices as stepping x and y one cell at a time.
+    x = np.cumsum([rect[0]] + [w / float(w_div)]*w_div)
+    y = np.cumsum([rect[1]] + [h / float(h_div)]*h_div)
+    # [h_div + 1, w_div + 1, 2] vertices, x varies along the columns and y along the rows.
+    grid = np.stack(np.broadcast_arrays(x[None, :], y[:, None]), 2).astype(int)
     return grid
 
 def distort_grid(org_grid, max_shift):
@@ -98,63 +88,157 @@ def distort_grid(org_grid, max_shift):
 
 def grid_to_mesh(src_grid, dst_grid):
     assert(src_grid.shape == dst_grid.shape)
-    mesh = []
-    for i in range(src_grid.shape[0] - 1):
-        for j in range(src_grid.shape[1] - 1):
-            src_quad = [src_grid[i    , j    , 0], src_grid[i    , j    , 1],
-                        src_grid[i + 1, j    , 0], src_grid[i + 1, j    , 1],
-                        src_grid[i + 1, j + 1, 0], src_grid[i + 1, j + 1, 1],
-                        src_grid[i    , j + 1, 0], src_grid[i    , j + 1, 1]]
-
-            dst_quad = [dst_grid[i    , j    , 0], dst_grid[i    , j    , 1],
-                        dst_grid[i + 1, j    , 0], dst_grid[i + 1, j    , 1],
-                        dst_grid[i + 1, j + 1, 0], dst_grid[i + 1, j + 1, 1],
-                        dst_grid[i    , j + 1, 0], dst_grid[i    , j + 1, 1]]
-            dst_rect = quad_to_rect(dst_quad)
-            mesh.append([dst_rect, src_quad])
-    return mesh
-
-def train_loop(data_x, data_y, model, loss_fn, optimizer, num_epochs=100, is_neg_loss=0, scheduler=None):
+    # corners (i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1) of every cell, as [cells, 8] quads.
+    corners = lambda g: np.concatenate([g[:-1, :-1], g[1:, :-1], g[1:, 1:], g[:-1, 1:]], 2).reshape(-1, 8)
+    src_quads = corners(src_grid)
+    dst_quads = corners(dst_grid)
+    assert(np.all(dst_quads[:, 0] == dst_quads[:, 2]) and np.all(dst_quads[:, 1] == dst_quads[:, 7]) and
+           np.all(dst_quads[:, 4] == dst_quads[:, 6]) and np.all(dst_quads[:, 3] == dst_quads[:, 5]))
+    dst_rects = dst_quads[:, [0, 1, 4, 3]]
+    return [[tuple(rect), quad] for rect, quad in zip(dst_rects.tolist(), src_quads.tolist())]
+
+def minibatch_epoch(data_x, data_y, model, loss_fn, optimizer, batch_size, is_neg_loss=0):
+    """
+    one pass over a fresh shuffle of the training rows, every step evaluates the model only at
+    `batch_size` rows against its representer set (see DeepKernelRegression.forward_rows).
+
+    returns the mean loss of the epoch.
+    """
+    perm = torch.randperm(len(data_x), device=data_y.device)
+    total_loss = 0
+    for rows in torch.split(perm, batch_size):
+        optimizer.zero_grad()
+        pred = model.forward_rows(rows)
+        loss = loss_fn(pred, data_y.index_select(-2, rows))
+        if is_neg_loss:
+            loss = -1*loss
+        loss.backward()
+        optimizer.step()
+        total_loss += loss.detach()*len(rows)
+    return total_loss / len(data_x)
+
+def log_callback(every=1000):
+    """
+    print the loss every `every` epochs, the only place the loss is pulled to the host.
+    """
+    def _fn(epoch, loss, model):
+        if epoch % every == 0:
+            print(f"{ epoch} loss: {loss.item():>7f}]")
+    return _fn
+
+def scheduler_callback(scheduler):
+    def _fn(epoch, loss, model):
+        scheduler.step()
+    return _fn
+
+def validation_loss(model, loss_fn, val_data):
+    val_x, val_y = val_data
+    with torch.no_grad():
+        if hasattr(model, 'predict'):
+            model.freeze()
+            return loss_fn(model.predict(val_x), val_y)
+        return loss_fn(model(val_x), val_y)
+
+def train_loop(data_x, data_y, model, loss_fn, optimizer, num_epochs=100, is_neg_loss=0, scheduler=None, batch_size=None,
+               check_every=100, tol=1e-9, val_data=None, patience=5, callbacks=None, profiler=None):
+    """
+    the losses stay on the device in a preallocated buffer, the host only looks at them every
+    `check_every` epochs so a training epoch is just the forward and backward work.
+
+    batch_size: if set, every epoch is a pass of mini-batch steps over shuffled rows instead of one full batch step.
+    check_every: epochs between convergence (|loss change| < tol anywhere in the window) and early stopping checks.
+    val_data: optional held out (val_x, val_y), training stops after `patience` checks without
+              improvement of the validation loss and the best weights are restored.
+    callbacks: list of fns called as cb(epoch, loss, model) after every epoch, `loss` is the on-device
+               tensor. defaults to logging every 1000 epochs, `scheduler` is stepped through a callback too.
+    profiler: a profiling.LayerProfiler, attached to the model for the run and summarized at its end.
+              with a trace_path set the whole run is also exported as a torch.profiler trace.
+
+    returns the loss history of the epochs that ran.
+    """
+
+    if callbacks is None:
+        callbacks = [log_callback(1000)]
+    if scheduler:
+        callbacks = callbacks + [scheduler_callback(scheduler)]
+
+    if profiler is not None:
+        set_profiler = hasattr(model, 'profiler')
+        if set_profiler:
+            model.profiler = profiler
+        trace = profiler.trace() if profiler.trace_path else contextlib.nullcontext()
+        with trace:
+            history = train_loop(data_x, data_y, model, loss_fn, optimizer, num_epochs, is_neg_loss, None, batch_size, check_every,
+                                 tol, val_data, patience, callbacks + [lambda epoch, loss, model: profiler.end_backward()])
+        if set_profiler:
+            model.profiler = None
+        print(profiler.summary())
+        return history
 
     print('training_epochs: ', num_epochs)
-    prev_loss = 0
-    loss = 0
+    history = None
+    best_val_loss = float('inf')
+    best_params = None
+    bad_checks = 0
+    epoch = -1
     for epoch in range(num_epochs):
 
-      # Backpropagation
-      optimizer.zero_grad()
-      # Compute prediction and loss
-      pred = model(data_x)
-      loss = loss_fn(pred, data_y)
+      if batch_size is None:
+          # Backpropagation
+          optimizer.zero_grad()
+          # Compute prediction and loss
+          pred = model(data_x)
+          loss = loss_fn(pred, data_y)
 
-      if is_neg_loss:
-          loss = -1*loss
-      is_last_epoch = (num_epochs - 1 ) == epoch
+          if is_neg_loss:
+              loss = -1*loss
 
-      if torch.abs(prev_loss - loss) < 0.000000001:
-          print('converged! in ', epoch, ' with loss: ', loss)
-          break
-      prev_loss = loss
-
-      loss.backward()
-      optimizer.step()
+          loss.backward()
+          optimizer.step()
+      else:
+          loss = minibatch_epoch(data_x, data_y, model, loss_fn, optimizer, batch_size, is_neg_loss)
 
-      if scheduler:
-          print('scheduler step')
-          scheduler.step()
+      if history is None:
+          history = torch.zeros(num_epochs, dtype=loss.dtype, device=loss.device)
+      history[epoch] = loss.detach()
 
+      for callback in callbacks:
+          callback(epoch, history[epoch], model)
 
-      if (epoch) % (1000 + 0*num_epochs) == 0:
-        loss = loss.item()
-        print(f"{ epoch} loss: {loss:>7f}]")
+      if (epoch + 1) % check_every != 0:
+          continue
 
-      if(is_last_epoch):
-          return True
+      window = history[max(epoch - check_every, 0): epoch + 1]
+      converged = torch.nonzero(torch.abs(window[1:] - window[:-1]) < tol)
+      if len(converged) > 0:
+          converged_epoch = max(epoch - check_every, 0) + converged[0].item() + 1
+          print('converged! in ', converged_epoch, ' with loss: ', history[converged_epoch].item())
+          break
 
-    print(f"{ num_epochs } loss: {loss:>7f}]")
+      if val_data is not None:
+          val_loss = validation_loss(model, loss_fn, val_data).item()
+          if val_loss < best_val_loss:
+              best_val_loss = val_loss
+              best_params = [p.detach().clone() for p in model.parameters()]
+              bad_checks = 0
+          else:
+              bad_checks += 1
+          if bad_checks >= patience:
+              print('early stopping in ', epoch, ' with validation loss: ', best_val_loss)
+              with torch.no_grad():
+                  for p, best_p in zip(model.parameters(), best_params):
+                      p.copy_(best_p)
+              break
+
+    if history is None:
+        return torch.zeros(0)
+    history = history[:epoch + 1]
+    print(f"{ len(history) } loss: {history[-1].item():>7f}]")
+    return history
 
 def createSyntheticData(num_data_points=10):
     #following the defination specified in the paper.
+    # NOTE: for large or higher dimensional (memory mapped) datasets see datasets.generate_dataset
     input_domain = {'x_0': [-1, 1],
              'x_1': [-1, 1]}
 
@@ -162,36 +246,16 @@ def createSyntheticData(num_data_points=10):
       return (0.1 + torch.abs(x_0 - x_1))**(-1)
 
     def test_fn_2(x_0, x_1):
-      return 1 if (x_0*x_1 > 3/20) else 0
+      return (x_0*x_1 > 3/20).long()
 
     # initializing the input domains
     x_0 = torch.linspace(input_domain['x_0'][0], input_domain['x_0'][1],num_data_points)
     x_1 = torch.linspace(input_domain['x_1'][0], input_domain['x_1'][1],num_data_points)
 
-    #initializing the grid and outputs
-    x_grid= []
-    output_1 = []
-    output_2 = []
-
-
-    for x in x_0:
-      out_1_row = []
-      out_2_row = []
-      for y in x_1:
-        # calculating the ouptuts
-        out_1 = test_fn_1(x, y)
-        out_2 = test_fn_2(x, y)
-        # appending the input values and fn outputs.
-        x_grid.append([x,y])
-        out_1_row.append(out_1)
-        out_2_row.append(out_2)
-      output_1.append(out_1_row)
-      output_2.append(out_2_row)
-
-    # converting the inputs and outputs to torch tensor with appropriate dimensions.
-    x_grid = torch.tensor(x_grid).reshape(num_data_points**2, 2)
-    output_1 = torch.tensor(output_1).reshape(num_data_points**2, 1)
-    output_2 = torch.tensor(output_2).reshape(num_data_points**2, 1)
+    # initializing the grid (x_1 varies fastest) and calculating the outputs for all points at once.
+    x_grid = torch.cartesian_prod(x_0, x_1).reshape(num_data_points**2, 2)
+    output_1 = test_fn_1(x_grid[:, 0], x_grid[:, 1]).reshape(num_data_points**2, 1)
+    output_2 = test_fn_2(x_grid[:, 0], x_grid[:, 1]).reshape(num_data_points**2, 1)
 
     domains = [2, 2]
     ranges  = [2, 1]
@@ -221,13 +285,29 @@ def e2eSKRR(data_x, data_y, device, num_epochs=100):
     model.train()
     likelihood.train()
     data_y = data_y.squeeze(1)
-    train_loop(data_x, data_y, model, loss, optimizer,num_epochs, is_neg_loss=1,  scheduler=lr_scheduler )
+    model.loss_history = train_loop(data_x, data_y, model, loss, optimizer,num_epochs, is_neg_loss=1,  scheduler=lr_scheduler )
 
     predY = model(data_x)
     print('predY from SKRR: ', predY)
 
     return model
 
+def directKRR(data_x, data_y, device, ridge=1e-3, solver='auto', kernel=None, precision=None):
+    """
+    single layer baseline in closed form (KernelRidgeRegression) instead of training SingleLayerKRR.
+    precision: precision policy of the kernel evaluation and the solve (see precision.py).
+    """
+    data_x = data_x.to(device)
+    data_y = data_y.to(device)*1.0
+
+    model = KernelRidgeRegression(kernel, ridge, solver, precision=precision)
+    model.kernel = model.kernel.to(device)
+    start = time.perf_counter()
+    model.fit(data_x, data_y)
+    print('direct KRR fit: ', 1e3*(time.perf_counter() - start), 'ms')
+
+    return model
+
 
 def test_e2eKRR(num_epochs=100):
     # check for cuda
@@ -236,21 +316,55 @@ def test_e2eKRR(num_epochs=100):
     _,ranges,data_x,data_y = createSyntheticData()
     return e2eKRR( data_x, data_y, ranges, device, num_epochs)
 
-def init_rls2_model(ranges, data_x, degree, device, retain_layer_outputs=False):
+def batched_mse_loss(pred, target):
+    # sum over the models of their own MSE, so every model gets the gradient it would get on its own.
+    return ((pred - target)**2).mean((-2, -1)).sum()
+
+def init_rls2_model(ranges, data_x, degree, device, retain_layer_outputs=False, num_landmarks=None, landmark_method='subsample', num_features=None, num_models=None, tile_size=None, recompute=False, grid=False, compile=None, precision=None):
     """
     define and initialize the model for experiment defined in section 4.2
+
+    num_landmarks: if set, every layer is expanded over this many landmark points instead of all of data_x.
+    num_features: if set, the outer Matern kernel is replaced by this many random fourier features.
+    num_models: if set, a batch of that many independent models is trained at once.
+    tile_size: if set, layers are evaluated from kernel blocks of this size without forming the N x N kernel.
+    recompute: regenerate the layer kernels in the backward pass instead of storing them.
+    grid: run the input layer through kronecker algebra if data_x is a cartesian grid (see DeepKernelRegression).
+    compile: compiled forward mode, 'auto', 'compile', 'trace' or 'eager' (see compiled.CompiledForward).
+    precision: dtypes of the kernel evaluation, accumulation and solves, a precision.PrecisionPolicy or its name.
     """
     # specify kernels for each layers.
     K0 = gpy.kernels.PolynomialKernel(degree) # inner Kernel
     K1 = gpy.kernels.MaternKernel() # outer kernel
+    if num_features is not None:
+        K1 = RandomFourierFeatures.from_kernel(K1, ranges[0], num_features)
     kernels = [K0, K1]
 
-    model = DeepKernelRegression(ranges, data_x, kernels, device, retain_layer_outputs=retain_layer_outputs)
+    model = DeepKernelRegression(ranges, data_x, kernels, device, retain_layer_outputs=retain_layer_outputs,
+                                 num_landmarks=num_landmarks, landmark_method=landmark_method, num_models=num_models, tile_size=tile_size, recompute=recompute, grid=grid, compile=compile, precision=precision)
     model = model.to(device)
 
     return model
 
-def e2eKRR( data_x, data_y, ranges, degree, device, num_epochs=100, model_path=None, load_model=False,save_model=False, retain_layer_outputs=False, vizCompGraph=False):
+def e2eKRR( data_x, data_y, ranges, degree, device, num_epochs=100, model_path=None, load_model=False,save_model=False, retain_layer_outputs=False, vizCompGraph=False, num_landmarks=None, landmark_method='subsample', num_features=None, solve_last_layer=False, ridge=1e-3, solver='cholesky', batch_size=None, val_data=None, callbacks=None, profiler=None, tile_size=None, recompute=False, world_size=None, grid=False, export_path=None, compile=None, precision=None):
+    """
+    val_data: held out (val_x, val_y) for early stopping, callbacks and profiler: see train_loop.
+    batch_size: mini-batch training, needs num_landmarks (or num_features) so that a step is bounded by the landmarks.
+    data_y of shape [num_models, N, 1] trains a batch of independent models (several targets, or the same
+    target expanded for several initializations) in one model, the loss is the sum of their MSEs.
+    solve_last_layer: variable projection training, the outer layer weights are solved in closed form
+                      (kernel ridge regression with `ridge` through `solver`: 'cholesky' or 'cg') at every
+                      step and only the inner layers take gradient steps.
+    grid: structured grid mode for grid shaped data_x (createSyntheticData), the input layer kernel is never formed.
+    compile: capture the layer stack once and reuse it across epochs ('auto', 'compile', 'trace'), see compiled.py.
+    precision: precision policy ('mixed' evaluates the kernels in float32 and accumulates and solves in float64,
+               see precision.py), it warns when a gram matrix is too ill conditioned for its dtype.
+    export_path: also write the trained model as a frozen inference artifact (see inference.py) to this directory.
+    world_size: data parallel training with this many local cpu processes (see distributed.train_distributed),
+                every process evaluates the layers at its shard of the rows. full batch training only, it can
+                not be combined with solve_last_layer, batch_size, val_data, callbacks, profiler,
+                retain_layer_outputs or the checkpoint options.
+    """
 
     # hyperparams
     learning_rate = 0.0005
@@ -262,20 +376,43 @@ def e2eKRR( data_x, data_y, ranges, degree, device, num_epochs=100, model_path=N
     print('e2eKRR num_epochs: ', num_epochs)
     print('data_x.device: ', data_x.device, device)
 
+    if world_size is not None:
+        # the workers run a plain full batch adam loop, the options of train_loop and the checkpoints are not supported.
+        options = dict(solve_last_layer=solve_last_layer, batch_size=batch_size is not None, val_data=val_data is not None,
+                       callbacks=bool(callbacks), profiler=profiler is not None, retain_layer_outputs=retain_layer_outputs,
+                       save_model=save_model, load_model=load_model, vizCompGraph=vizCompGraph)
+        unsupported = [name for name, used in options.items() if used]
+        if unsupported:
+            raise ValueError('world_size (distributed training) can not be combined with ' + ', '.join(unsupported))
+        from distributed import train_distributed # imports this module.
+        model = train_distributed(data_x, data_y, ranges, degree, world_size, num_epochs, learning_rate,
+                                  num_landmarks=num_landmarks, landmark_method=landmark_method, num_features=num_features,
+                                  num_models=data_y.shape[0] if data_y.dim() == 3 else None,
+                                  tile_size=tile_size, recompute=recompute, grid=grid, compile=compile, precision=precision)
+        print('training throughput: ', model.epochs_per_s, ' epochs/s')
+        if export_path is not None:
+            export_artifact(model, export_path)
+        return model
+
     # initializing the main training loop components.
-    model = init_rls2_model(ranges, data_x, degree, device, retain_layer_outputs=retain_layer_outputs)
+    model = init_rls2_model(ranges, data_x, degree, device, retain_layer_outputs=retain_layer_outputs,
+                            num_landmarks=num_landmarks, landmark_method=landmark_method, num_features=num_features,
+                            num_models=data_y.shape[0] if data_y.dim() == 3 else None, tile_size=tile_size, recompute=recompute, grid=grid, compile=compile, precision=precision)
+    data_y = data_y.to(model.Weights[-1].dtype) # the loss is in the dtype of the model outputs.
     predY = model(data_x)
     print(model.parameters()[0].is_leaf, model.parameters()[1].is_leaf)
 
     if vizCompGraph:
+        import torchviz # only needed to draw the graph.
         p = torchviz.make_dot(predY.sum(), params=dict({"K1_weights":model.parameters()[0], 
                                                         "K2_weights": model.parameters()[1] }),
                               show_attrs=True, show_saved=True)
 
         p.render('somefile'+str(degree)+'.gv', view=True)
 
-    loss = nn.MSELoss()
-    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate, weight_decay=1e-5)
+    loss = nn.MSELoss() if data_y.dim() < 3 else batched_mse_loss
+    train_params = model.parameters()[:-1] if solve_last_layer else model.parameters()
+    optimizer = torch.optim.Adam(train_params, lr=learning_rate, weight_decay=1e-5)
 
     if load_model:
         checkpoint = torch.load(model_path)
@@ -286,7 +423,17 @@ def e2eKRR( data_x, data_y, ranges, degree, device, num_epochs=100, model_path=N
         model.load_params(params)
         print('model sucessfully loaded! from '+model_path)
 
-    train_loop(data_x, data_y, model, loss, optimizer, num_epochs,is_neg_loss=0)
+    train_model = model
+    if solve_last_layer:
+        if batch_size is not None or val_data is not None:
+            raise ValueError('solve_last_layer needs the full batch, it can not be combined with batch_size or val_data')
+        train_model = VariableProjection(model, data_y, ridge, solver)
+    model.loss_history = train_loop(data_x, data_y, train_model, loss, optimizer, num_epochs,is_neg_loss=0,
+                                    batch_size=batch_size, val_data=val_data, callbacks=callbacks, profiler=profiler)
+    model.profiler = None
+    model.freeze()
+    if model.kernel_cache is not None:
+        print('kernel cache: ', model.kernel_cache.stats())
 
     if save_model:
         torch.save({
@@ -298,5 +445,40 @@ def e2eKRR( data_x, data_y, ranges, degree, device, num_epochs=100, model_path=N
                 }, model_path)
         print('model saved! @ '+model_path)
 
+    if export_path is not None:
+        export_artifact(model, export_path)
+
     torch.cuda.empty_cache()
     return model
+
+def update_e2eKRR(model, data_x_new, data_y, num_epochs=100, ridge=1e-3, solver='cholesky', solve_last_layer=True, batch_size=None, callbacks=None):
+    """
+    incremental training of a trained e2eKRR model after new points arrived, instead of a retrain from random weights.
+
+    data_x_new: the new inputs, they are appended to the representer set (DeepKernelRegression.add_points).
+    data_y: the targets of all points, the old ones followed by the new ones.
+    the output layer is first solved in closed form on all points, then the inner layers are fine tuned for
+    num_epochs while the output layer is solved again at every step (variable projection, see e2eKRR).
+    solve_last_layer=False fine tunes all layers by gradient instead, the first steps of Adam can undo the
+    closed form warm start. mini-batches (batch_size) need solve_last_layer=False.
+    """
+    if solve_last_layer and batch_size is not None:
+        raise ValueError('solve_last_layer needs the full batch, pass solve_last_layer=False to train with batch_size')
+    learning_rate = 0.0005
+    model.add_points(data_x_new)
+    data_x = model._inputs
+    data_y = data_y.to(data_x.device, model.Weights[-1].dtype)
+
+    # closed form warm start of the output layer for the extended representer set.
+    model.solve_last_layer(data_x, data_y, ridge, solver)
+
+    loss = nn.MSELoss() if data_y.dim() < 3 else batched_mse_loss
+    train_params = model.parameters()[:-1] if solve_last_layer else model.parameters()
+    optimizer = torch.optim.Adam(train_params, lr=learning_rate, weight_decay=1e-5)
+    train_model = VariableProjection(model, data_y, ridge, solver) if solve_last_layer else model
+    model.loss_history = train_loop(data_x, data_y, train_model, loss, optimizer, num_epochs, is_neg_loss=0,
+                                    batch_size=batch_size, callbacks=callbacks)
+    model.freeze()
+    if model.kernel_cache is not None:
+        print('kernel cache: ', model.kernel_cache.stats())
+    return model
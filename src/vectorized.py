@@ -1,5 +1,6 @@
 import torch
 import gpytorch
+from rff import RandomFourierFeatures
 
 def polyKernel(d):
     # following the implementation, similar to gpy.kernel.PolynomialKernel
@@ -15,31 +16,243 @@ def ker(x1, x2, ker, rkhs_range, device):
     k = k.unsqueeze(2) 
     k = k.expand(*k.shape[:2], rkhs_range)
     k = k.unsqueeze(2) 
-    ey = torch.eye(rkhs_range).unsqueeze(2).expand(rkhs_range,rkhs_range, k.shape[0]).T
-    ey = torch.eye(rkhs_range).reshape(1,1, rkhs_range, rkhs_range).expand(*k.shape[: 2], rkhs_range, rkhs_range).to(device)
+    ey = torch.eye(rkhs_range, dtype=k.dtype, device=device).reshape(1,1, rkhs_range, rkhs_range).expand(*k.shape[: 2], rkhs_range, rkhs_range)
     return k.mul(ey)
 
-def rkhs_fn(X,Y,base_kernel, weights, rkhs_range, device):
-    k = ker(X, Y, base_kernel, rkhs_range, device)
-    return weights.matmul(k).sum(1).squeeze(1) # realization at Y of weight linear combination of basis functions indexed by X
+def gram(x1, x2, ker, cache=None):
+    """
+    dense kernel matrix K(x1, x2) of shape [N1, N2].
 
-def fn_init(Kernel, Ker_weights, range, device):
+    when both arguments are the same tensor the kernel is called once in its
+    symmetric form so that it can reuse the x1 == x2 computations.
+    cache: optional KernelCache for constant gram matrices (the input layer), only pass it for inputs that
+           do not change between calls. skipped when an input requires grad.
+    """
+    if cache is not None and not (x1.requires_grad or x2.requires_grad):
+        return cache.gram(x1, x2, ker, gram)
+    if x1 is x2 and isinstance(ker, gpytorch.kernels.Kernel):
+        k = ker(x1)
+    else:
+        k = ker(x1, x2)
+    if hasattr(k, 'evaluate'):
+        k = k.evaluate()
+    return k
+
+class TiledKernel:
+    def __init__(self, x1, x2, kernel, tile_size=1024):
+        """
+        lazy kernel matrix K(x1, x2) that is never materialized, products with it are computed
+        block by block so at most a [tile_size, tile_size] block of the kernel exists at a time.
+        for K(x, x) only the blocks on and above the diagonal are evaluated.
+        """
+        self.x1 = x1
+        self.x2 = x2
+        self.kernel = kernel
+        self.tile_size = tile_size
+        self.shape = (*x1.shape[:-1], x2.shape[-2])
+
+    def block(self, r0, r1, c0, c1):
+        return gram(self.x1[..., r0:r1, :], self.x2[..., c0:c1, :], self.kernel)
+
+    def blocks(self, symmetric=None):
+        """
+        (r0, r1, c0, c1, mirrored) of every block to evaluate, `mirrored` blocks also stand in for K[c, r].
+        """
+        N1, N2, t = self.x1.shape[-2], self.x2.shape[-2], self.tile_size
+        if symmetric is None:
+            symmetric = self.x1 is self.x2
+        for r0 in range(0, N1, t):
+            for c0 in range(r0 if symmetric else 0, N2, t):
+                yield r0, min(r0 + t, N1), c0, min(c0 + t, N2), symmetric and c0 != r0
+
+    def matmul(self, W, symmetric=None):
+        t = self.tile_size
+        acc = [0]*len(range(0, self.x1.shape[-2], t))
+        for r0, r1, c0, c1, mirrored in self.blocks(symmetric):
+            k = self.block(r0, r1, c0, c1).to(W.dtype)
+            acc[r0 // t] = acc[r0 // t] + k.matmul(W[..., c0:c1, :])
+            if mirrored:
+                # the mirrored block K(x[c], x[r]) = K(x[r], x[c])ᵀ
+                acc[c0 // t] = acc[c0 // t] + k.transpose(-1, -2).matmul(W[..., r0:r1, :])
+        return torch.cat(acc, -2)
+
+    def evaluate(self):
+        return gram(self.x1, self.x2, self.kernel)
+
+def _sum_to(grad, shape):
+    # undo the broadcasting of a shared (un-batched) input against batched weights.
+    while grad.dim() > len(shape):
+        grad = grad.sum(0)
+    return grad
+
+class TiledKernelMatmul(torch.autograd.Function):
+    """
+    K(x1, x2) @ W that saves only x1, x2 and W for backward, the kernel blocks are evaluated again
+    (with autograd) during the backward pass. memory is one [tile_size, tile_size] block, independent
+    of N² and, stacked over layers, of the depth. extra inputs are the kernel hyperparameters.
+    """
+    @staticmethod
+    def forward(ctx, x1, x2, W, kernel, tile_size, symmetric, *params):
+        ctx.kernel, ctx.tile_size, ctx.symmetric = kernel, tile_size, symmetric
+        ctx.save_for_backward(x1, x2, W, *params)
+        with torch.no_grad():
+            return TiledKernel(x1, x2, kernel, tile_size).matmul(W, symmetric)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x1, x2, W, *params = ctx.saved_tensors
+        op = TiledKernel(x1.detach(), x2.detach(), ctx.kernel, ctx.tile_size)
+        grad_x1, grad_x2, grad_W = torch.zeros_like(x1), torch.zeros_like(x2), torch.zeros_like(W)
+        grad_params = [torch.zeros_like(p) for p in params]
+        inputs_grad = [x1.requires_grad, x2.requires_grad] + [p.requires_grad for p in params]
+
+        for r0, r1, c0, c1, mirrored in op.blocks(ctx.symmetric):
+            with torch.enable_grad():
+                x1_b = x1[..., r0:r1, :].detach().requires_grad_(x1.requires_grad)
+                x2_b = x2[..., c0:c1, :].detach().requires_grad_(x2.requires_grad)
+                k = gram(x1_b, x2_b, ctx.kernel).to(W.dtype)
+
+            # out[r] += k @ W[c] (and out[c] += kᵀ @ W[r] for mirrored blocks)
+            g_r, W_c = grad_out[..., r0:r1, :], W[..., c0:c1, :]
+            grad_W[..., c0:c1, :] += _sum_to(k.detach().transpose(-1, -2).matmul(g_r), W_c.shape)
+            grad_k = g_r.matmul(W_c.transpose(-1, -2))
+            if mirrored:
+                g_c, W_r = grad_out[..., c0:c1, :], W[..., r0:r1, :]
+                grad_W[..., r0:r1, :] += _sum_to(k.detach().matmul(g_c), W_r.shape)
+                grad_k = grad_k + W_r.matmul(g_c.transpose(-1, -2))
+
+            if not any(inputs_grad):
+                continue
+            wrt = [t for t, needed in zip([x1_b, x2_b] + list(params), inputs_grad) if needed]
+            grads = iter(torch.autograd.grad(k, wrt, _sum_to(grad_k, k.shape), allow_unused=True))
+            if x1.requires_grad:
+                g = next(grads)
+                if g is not None:
+                    grad_x1[..., r0:r1, :] += g
+            if x2.requires_grad:
+                g = next(grads)
+                if g is not None:
+                    grad_x2[..., c0:c1, :] += g
+            for grad_p, needed in zip(grad_params, inputs_grad[2:]):
+                if needed:
+                    g = next(grads)
+                    if g is not None:
+                        grad_p += g
+
+        return (grad_x1, grad_x2, grad_W, None, None, None, *grad_params)
+
+def kernel_matmul(X, Y, kernel, weights, tile_size=None):
+    """
+    K(X, Y) @ weights with the kernel recomputed in backward (see TiledKernelMatmul).
+    """
+    params = list(kernel.parameters()) if isinstance(kernel, torch.nn.Module) else []
+    tile_size = tile_size or max(X.shape[-2], Y.shape[-2])
+    return TiledKernelMatmul.apply(X, Y, weights, kernel, tile_size, X is Y, *params)
+
+def rkhs_fn(X,Y,base_kernel, weights, rkhs_range, device, cache=None, tile_size=None, recompute=False, precision=None):
+    # K(X, Y) @ W is the same as the block diagonal form of `ker` (K(X, Y) ⊗ I_R)
+    # contracted with the weights, without materializing the [N, N, R, R] tensor.
+    # with a precision policy K is evaluated in its kernel dtype and accumulated in the one of the weights.
+    if precision is not None:
+        X, Y = precision.kernel_inputs(X, Y, cache)
+    if recompute:
+        # memory efficient autograd, no kernel matrix is kept alive between forward and backward.
+        return kernel_matmul(X, Y, base_kernel, weights.squeeze(-2), tile_size)
+    if tile_size is not None:
+        # lazy path, the kernel is only ever evaluated in [tile_size, tile_size] blocks.
+        return TiledKernel(X, Y, base_kernel, tile_size).matmul(weights.squeeze(-2))
+    k = gram(X, Y, base_kernel, cache)
+    out = k.to(weights.dtype).matmul(weights.squeeze(-2))
+    if precision is not None:
+        precision.check_kernel(k, weights, out, key=id(base_kernel))
+    return out # realization at X of weight linear combination of basis functions indexed by Y
+
+def feature_fn(X, feature_map, weights, precision=None):
+    # primal form of a layer, phi(X) @ W, linear in the number of points.
+    if precision is not None:
+        X = X.to(precision.kernel)
+    return feature_map.features(X).to(weights.dtype).matmul(weights.squeeze(-2))
+
+def fn_init(Kernel, Ker_weights, range, device, cache=None, tile_size=None, recompute=False, precision=None):
     """
     this function simply set the args for our main 'fn' function.
     """
 
-    def fn_with_specified_args(inputs, val):
-        return rkhs_fn(inputs, val, Kernel, Ker_weights, range, device)
+    if isinstance(Kernel, RandomFourierFeatures):
+        # feature space layer, it has no centers so `val` is ignored.
+        def fn_with_specified_args(inputs, val):
+            return feature_fn(inputs, Kernel, Ker_weights, precision)
+    else:
+        def fn_with_specified_args(inputs, val):
+            return rkhs_fn(inputs, val, Kernel, Ker_weights, range, device, cache, tile_size, recompute, precision)
+
+    fn_with_specified_args.kernel = Kernel
     return fn_with_specified_args
 
-def realize_composite_fns(fn_arr, input, val, retain_layer_outputs=False):
+def select_landmarks(X, num_landmarks, method='subsample', seed=None, num_iters=10):
+    """
+    pick `num_landmarks` row indices of X to expand a layer over (Nyström / inducing points).
+
+    method:
+        subsample: uniform subsample of the rows.
+        kmeans: lloyd iterations on X, each centroid is then snapped to its nearest row so that
+                the landmarks stay images of training points in every layer.
+    """
+    N = X.shape[0]
+    if num_landmarks >= N:
+        return torch.arange(N, device=X.device)
+
+    generator = torch.Generator()
+    if seed is not None:
+        generator.manual_seed(seed)
+    perm = torch.randperm(N, generator=generator)[:num_landmarks].to(X.device)
+
+    if method == 'subsample':
+        return perm.sort().values
+    if method != 'kmeans':
+        raise ValueError('unknown landmark method: ' + str(method))
+
+    X = X.detach()
+    centroids = X[perm].clone()
+    for _ in range(num_iters):
+        assign = torch.cdist(X, centroids).argmin(1)
+        counts = torch.bincount(assign, minlength=num_landmarks).unsqueeze(1)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, X)
+        # empty clusters keep their previous centroid.
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+
+    return torch.cdist(centroids, X).argmin(1).unique()
+
+def select_centers(val, landmarks=None, cache=None):
+    """
+    the rows of `val` a layer is expanded over, all of them or only the landmarks.
+    """
+    if landmarks is None:
+        return val
+    if cache is not None and not val.requires_grad:
+        return cache.rows(val, landmarks)
+    return val.index_select(-2, landmarks)
+
+def realize_composite_fns(fn_arr, input, val, retain_layer_outputs=False, landmarks=None, cache=None, profiler=None):
+  """
+  landmarks: optional list with one index tensor (or None) per layer, a layer with landmarks
+             is expanded only over those rows of its input i.e, K(val, val[landmarks]) @ W.
+  cache: optional KernelCache for the centers of the input layer, the only constant layer input.
+  profiler: optional profiling.LayerProfiler that times and measures every layer.
+  """
   prev_val = val
 
   layer_outputs = []
+  if landmarks is None:
+    landmarks = [None]*len(fn_arr)
   # TODO: reverse the order of fn_arr
-  for curr_fn in fn_arr:
-    
-    curr_val = curr_fn(prev_val, prev_val)
+  for i, (curr_fn, curr_landmarks) in enumerate(zip(fn_arr, landmarks)):
+
+    centers = select_centers(prev_val, curr_landmarks, cache if i == 0 else None)
+    if profiler is None:
+        curr_val = curr_fn(prev_val, centers)
+    else:
+        curr_val = profiler.run_layer(i, curr_fn, prev_val, centers)
     # print(curr_fn, prev_val, curr_val)
     prev_val = curr_val
 
@@ -48,7 +261,17 @@ def realize_composite_fns(fn_arr, input, val, retain_layer_outputs=False):
 
   return prev_val,layer_outputs
 
-def compose(skel_fn_arr, input, retain_layer_outputs):
+def realize_composite_fns_at(fn_arr, centers, val):
+  """
+  evaluate the composition at new points `val` where each layer is expanded
+  over the fixed `centers` (the image of the training inputs at that layer).
+  """
+  prev_val = val
+  for curr_fn, curr_centers in zip(fn_arr, centers):
+    prev_val = curr_fn(prev_val, curr_centers)
+  return prev_val
+
+def compose(skel_fn_arr, input, retain_layer_outputs, landmarks=None, cache=None, profiler=None):
   """
   given a array of fns this function calculates the composition of these function in mathematically consistent fashion
   i.e, compose([fn1, fn2, fn3], x) == fn1 ° fn2 ° fn3 == fn1(fn2(fn3(x))) respectively.
@@ -57,5 +280,5 @@ def compose(skel_fn_arr, input, retain_layer_outputs):
 
   #fn_arr = preprocess(skel_fn_arr, input) # function in the subspace of rkhs spanned by the repe_eval_at_prev_inputs. NOTE: skeleton of rep eval is present in each skel_fn_arr entry.
   def fn(val):
-    return  realize_composite_fns(fn_arr,input, val, retain_layer_outputs)
+    return  realize_composite_fns(fn_arr,input, val, retain_layer_outputs, landmarks, cache, profiler)
   return fn
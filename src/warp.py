@@ -0,0 +1,87 @@
+"""
+numpy mesh warp engine for the layer deformation figures (repr_fig6).
+
+a layer maps every node of the input grid to a new position (layer_outputs[0]), the warp renders the
+image living on the input grid at those positions: the node values and positions are bilinearly
+upsampled to a dense sample grid, and every sample is splatted with bilinear weights into the four
+output pixels around its destination (the forward bilinear distortion of ImageMagick, in one pass).
+"""
+import numpy as np
+
+def _interpolation_matrix(n, size):
+    # [size, n] weights of the linear interpolation of n nodes at `size` evenly spaced positions.
+    pos = np.linspace(0, n - 1, size)
+    i0 = np.minimum(np.floor(pos).astype(np.int64), max(n - 2, 0))
+    f = pos - i0
+    M = np.zeros([size, n])
+    M[np.arange(size), i0] = 1 - f
+    M[np.arange(size), np.minimum(i0 + 1, n - 1)] += f
+    return M
+
+def upsample(grid, shape):
+    """
+    bilinear upsampling of a node grid [n, m, ...] to [H, W, ...], the corner nodes stay the corners.
+    bilinear interpolation is separable, so this is two small matrix products.
+    """
+    rows = _interpolation_matrix(grid.shape[0], shape[0])
+    cols = _interpolation_matrix(grid.shape[1], shape[1])
+    return np.einsum('in,nm...,jm->ij...', rows, grid, cols, optimize=True)
+
+def splat(values, rows, cols, shape, fill=np.nan):
+    """
+    forward bilinear splatting: every value is spread over the four pixels around (row, col) of an
+    image of `shape` and every pixel is the weighted mean of what landed on it, `fill` where nothing did.
+    """
+    H, W = shape
+    values = values.reshape(len(rows), -1)
+    r0 = np.floor(rows).astype(np.int64)
+    c0 = np.floor(cols).astype(np.int64)
+    fr = rows - r0
+    fc = cols - c0
+
+    acc = np.zeros([H*W, values.shape[1]])
+    weight = np.zeros(H*W)
+    for dr, dc, w in ((0, 0, (1 - fr)*(1 - fc)), (0, 1, (1 - fr)*fc), (1, 0, fr*(1 - fc)), (1, 1, fr*fc)):
+        r, c = r0 + dr, c0 + dc
+        ok = (r >= 0) & (r < H) & (c >= 0) & (c < W)
+        idx = r[ok]*W + c[ok]
+        weight += np.bincount(idx, weights=w[ok], minlength=H*W)
+        for k in range(values.shape[1]):
+            acc[:, k] += np.bincount(idx, weights=w[ok]*values[ok, k], minlength=H*W)
+
+    covered = weight > 1e-12
+    out = np.full_like(acc, fill)
+    out[covered] = acc[covered] / weight[covered, None]
+    return out.reshape(H, W, *([values.shape[1]] if values.shape[1] > 1 else []))
+
+def warp_layer(values, layer_out, resolution=512, supersample=2, bounds=None, fill=np.nan):
+    """
+    render the image `values` [n, n, ...] of the input grid (row = first coordinate, column = second)
+    at the positions `layer_out` [n*n, 2] the layer maps the grid nodes to.
+
+    resolution: size of the square output image, supersample: dense samples per output pixel and axis.
+    bounds: ((min_0, max_0), (min_1, max_1)) of the output image, default the bounding box of layer_out.
+    returns the warped image and its bounds (for imshow's extent).
+    """
+    n, m = values.shape[:2]
+    positions = np.asarray(layer_out, dtype=np.float64).reshape(n, m, 2)
+    if bounds is None:
+        bounds = tuple((positions[..., k].min(), positions[..., k].max()) for k in range(2))
+
+    dense = (resolution*supersample, resolution*supersample)
+    dense_values = upsample(np.asarray(values, dtype=np.float64), dense)
+    dense_positions = upsample(positions, dense)
+
+    (lo0, hi0), (lo1, hi1) = bounds
+    rows = (dense_positions[..., 0] - lo0) / max(hi0 - lo0, 1e-12) * (resolution - 1)
+    cols = (dense_positions[..., 1] - lo1) / max(hi1 - lo1, 1e-12) * (resolution - 1)
+    img = splat(dense_values.reshape(rows.size, -1), rows.reshape(-1), cols.reshape(-1), (resolution, resolution), fill)
+    return img, bounds
+
+def roll_columns(img, shifts):
+    """
+    np.roll of every column i of img by shifts[i] (along the rows) at once.
+    """
+    H = img.shape[0]
+    rows = (np.arange(H)[:, None] - np.asarray(shifts)[None, :]) % H
+    return np.take_along_axis(img, rows, 0)